@@ -0,0 +1,73 @@
+"""Compare CPU spent serializing listing payloads before and after MongoJSONResponse.
+
+Run from the backend directory: python benchmark_serialization.py [count]
+"""
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from server import MongoJSONResponse
+
+def make_listings(count):
+    """Documents shaped like db.listings rows, as pymongo returns them"""
+    created = datetime.utcnow()
+    return [
+        {
+            "_id": ObjectId(),
+            "listing_id": str(uuid.uuid4()),
+            "seller_id": str(uuid.uuid4()),
+            "title": f"{i % 50 + 1} acre agricultural plot",
+            "area": f"{i % 50 + 1} acres",
+            "price": str(500000 + i * 1000),
+            "description": "Fertile land with road access, water source and clear title. " * 3,
+            "location": ["Pune", "Nashik", "Satara", "Kolhapur"][i % 4],
+            "google_maps_link": "https://maps.google.com/?q=18.5204,73.8567",
+            "latitude": "18.5204",
+            "longitude": "73.8567",
+            "photos": [f"https://onlyland.s3.eu-north-1.amazonaws.com/photos/{uuid.uuid4()}.jpg" for _ in range(3)],
+            "photo_placeholders": [None, None, None],
+            "videos": [],
+            "status": "active",
+            "created_at": created - timedelta(minutes=i),
+            "updated_at": created,
+        }
+        for i in range(count)
+    ]
+
+def old_path(listings):
+    """What list endpoints did before: str() every _id, jsonable_encoder, stdlib json"""
+    for listing in listings:
+        listing["_id"] = str(listing["_id"])
+    return JSONResponse(jsonable_encoder({"listings": listings})).body
+
+def new_path(listings):
+    """Projection already dropped _id; orjson encodes datetimes natively"""
+    return MongoJSONResponse({"listings": listings}).body
+
+def measure(path, count, rounds):
+    best = None
+    for _ in range(rounds):
+        listings = make_listings(count)
+        if path is new_path:
+            for listing in listings:
+                del listing["_id"]
+        start = time.process_time()
+        body = path(listings)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = 5
+    old_cpu, old_size = measure(old_path, count, rounds)
+    new_cpu, new_size = measure(new_path, count, rounds)
+    print(f"Serializing {count} listings (best of {rounds}, CPU time):")
+    print(f"  jsonable_encoder + json: {old_cpu * 1000:8.1f} ms  {old_size} bytes")
+    print(f"  MongoJSONResponse:       {new_cpu * 1000:8.1f} ms  {new_size} bytes")
+    print(f"  Speedup: {old_cpu / max(new_cpu, 1e-9):.1f}x")
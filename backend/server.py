@@ -1,5 +1,5 @@
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Form
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Form, Request, Header
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
@@ -8,24 +8,191 @@ from typing import Optional, List
 import os
 import jwt
 import hashlib
+import hmac
+import secrets
 from datetime import datetime, timedelta
 import uuid
 import time
 import boto3
 from botocore.exceptions import ClientError
 import pymongo
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument, UpdateOne, ASCENDING, DESCENDING, monitoring
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import razorpay
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from twilio.base.exceptions import TwilioRestException
 import json
+import logging
+import logging.handlers
+import queue
+import contextvars
+import copy
+import atexit
+import inspect
+import traceback
+import gzip
+import orjson
 import base64
+import math
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import io
+import ipaddress
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+from PIL import Image, ImageCms, ImageOps
+from pillow_heif import register_heif_opener
 from dotenv import load_dotenv
 
+# Lets Pillow open HEIC/HEIF photos from iPhones, here and in the media pool processes
+register_heif_opener()
+
+# Brotli responses are offered only when the optional module is installed; gzip always works
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Load environment variables from .env file
 load_dotenv()
 
+def json_default(value):
+    """Encode the BSON types orjson doesn't know natively"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+class MongoJSONResponse(JSONResponse):
+    """JSON response rendered by orjson, which encodes datetime natively and ObjectId via json_default
+
+    Returning an instance directly from a route also skips FastAPI's jsonable_encoder pass.
+    """
+
+    def render(self, content):
+        with trace_span("serialize", "orjson"):
+            return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Response compression
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+# Images and videos are already compressed; recompressing them only burns CPU
+COMPRESSIBLE_CONTENT_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+def negotiate_encoding(accept_encoding):
+    """Pick the best encoding we support from an Accept-Encoding header, or None"""
+    offered = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            offered[name.strip()] = quality
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best = None
+    for encoding in candidates:
+        quality = offered.get(encoding, offered.get("*", 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+def compress_body(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def vary_with_accept_encoding(headers):
+    """Merge every Vary header value with Accept-Encoding, keeping e.g. CORS's Vary: Origin"""
+    fields = []
+    for key, value in headers:
+        if key.lower() == b"vary":
+            fields += [field.strip() for field in value.decode("latin-1").split(",") if field.strip()]
+    if not any(field == "*" or field.lower() == "accept-encoding" for field in fields):
+        fields.append("Accept-Encoding")
+    return ", ".join(fields).encode("latin-1")
+
+class CompressionMiddleware:
+    """Compress single-chunk text/JSON responses above a size threshold
+
+    Streaming responses (files, videos) and responses that already carry a
+    Content-Encoding, such as precompressed catalogue bodies, pass through untouched.
+    """
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = next(
+            (value.decode("latin-1") for key, value in scope["headers"] if key == b"accept-encoding"), ""
+        )
+        encoding = negotiate_encoding(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            headers = {key.lower(): value for key, value in start_message.get("headers", [])}
+            content_type = headers.get(b"content-type", b"").decode("latin-1")
+            body = message.get("body", b"")
+            if (
+                message.get("more_body", False)
+                or b"content-encoding" in headers
+                or len(body) < self.minimum_size
+                or not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES)
+            ):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            with trace_span("compress", encoding):
+                compressed = compress_body(body, encoding)
+            response_headers = [
+                (key, value) for key, value in start_message.get("headers", [])
+                if key.lower() not in (b"content-length", b"vary")
+            ]
+            response_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", vary_with_accept_encoding(start_message.get("headers", []))),
+            ]
+            await send(dict(start_message, headers=response_headers))
+            await send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+        await self.app(scope, receive, send_compressed)
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(default_response_class=MongoJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -36,6 +203,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(CompressionMiddleware)
+
 # Environment variables
 MONGO_URL = os.environ.get('MONGO_URL')
 DB_NAME = os.environ.get('DB_NAME', 'onlylands')
@@ -47,10 +216,83 @@ ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'admin123')
 TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
 TWILIO_VERIFY_SERVICE_SID = os.environ.get('TWILIO_VERIFY_SERVICE_SID')
+TWILIO_TIMEOUT_SECONDS = float(os.environ.get('TWILIO_TIMEOUT_SECONDS', '5'))
+TWILIO_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('TWILIO_BREAKER_FAILURE_THRESHOLD', '5'))
+TWILIO_BREAKER_RESET_SECONDS = float(os.environ.get('TWILIO_BREAKER_RESET_SECONDS', '30'))
+
+# WhatsApp broadcasts of new listings to brokers in the same location
+# "twilio_whatsapp" sends through Twilio; "log" is a stand-in that only prints
+BROADCAST_PROVIDER = os.environ.get('BROADCAST_PROVIDER', 'twilio_whatsapp')
+TWILIO_WHATSAPP_FROM = os.environ.get('TWILIO_WHATSAPP_FROM')
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '8'))
+# Twilio queues WhatsApp sends per sender; stay under the account's messages/second
+BROADCAST_RATE_PER_SECOND = int(os.environ.get('BROADCAST_RATE_PER_SECOND', '10'))
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', '200'))
+BROADCAST_MAX_SEND_ATTEMPTS = 3
+LEADS_BATCH_SIZE = int(os.environ.get('LEADS_BATCH_SIZE', '500'))
+LEADS_PAGE_SIZE = 20
+LEADS_MAX_PAGE_SIZE = 100
+
+# Seller contact lookups
+SELLER_PHONE_CACHE_TTL_SECONDS = int(os.environ.get('SELLER_PHONE_CACHE_TTL_SECONDS', '300'))
+SELLER_PHONE_CACHE_MAX_ENTRIES = int(os.environ.get('SELLER_PHONE_CACHE_MAX_ENTRIES', '10000'))
+SELLER_PHONE_BATCH_MAX = 100
+
+# Seller listing previews
+PREVIEW_FIELDS = ["listing_id", "title", "location", "area", "price", "status", "created_at", "cover_photo"]
+PREVIEW_DEFAULT_LIMIT = 6
+PREVIEW_MAX_LIMIT = 24
+PREVIEW_MAX_SELLERS = 20
+CONTACT_EVENT_BATCH_SIZE = int(os.environ.get('CONTACT_EVENT_BATCH_SIZE', '200'))
+CONTACT_EVENT_FLUSH_SECONDS = float(os.environ.get('CONTACT_EVENT_FLUSH_SECONDS', '5'))
+
+# Active listing catalogue cache. Listings also change in the worker and reconcile
+# processes, which cannot reach this process's cache, so entries also expire after a TTL.
+CATALOGUE_CACHE_TTL_SECONDS = float(os.environ.get('CATALOGUE_CACHE_TTL_SECONDS', '15'))
+
+# OTP engine: "twilio_verify" lets Twilio Verify own the codes, "local" generates and checks
+# them against the otp_codes collection and only uses a provider to deliver the SMS
+OTP_ENGINE = os.environ.get('OTP_ENGINE', 'twilio_verify')
+# SMS delivery for the local engine: "twilio", or the "console"/"null" stand-ins for load tests
+OTP_SMS_BACKEND = os.environ.get('OTP_SMS_BACKEND', 'twilio')
+OTP_LENGTH = int(os.environ.get('OTP_LENGTH', '6'))
+OTP_TTL_SECONDS = int(os.environ.get('OTP_TTL_SECONDS', '300'))
+OTP_MAX_ATTEMPTS = int(os.environ.get('OTP_MAX_ATTEMPTS', '5'))
+OTP_HASH_SECRET = os.environ.get('OTP_HASH_SECRET') or JWT_SECRET
+TWILIO_SMS_FROM = os.environ.get('TWILIO_SMS_FROM')
+TWILIO_MESSAGING_SERVICE_SID = os.environ.get('TWILIO_MESSAGING_SERVICE_SID')
+
+# send-otp rate limits as "<burst>/<seconds to refill the burst>"
+OTP_RATE_LIMIT_PHONE = os.environ.get('OTP_RATE_LIMIT_PHONE', '3/600')
+OTP_RATE_LIMIT_IP = os.environ.get('OTP_RATE_LIMIT_IP', '10/600')
+OTP_RATE_LIMIT_GLOBAL = os.environ.get('OTP_RATE_LIMIT_GLOBAL', '50/10')
+# "memory" keeps buckets per process; "mongo" also enforces them across workers via rate_limits
+OTP_RATE_LIMIT_BACKEND = os.environ.get('OTP_RATE_LIMIT_BACKEND', 'memory')
+# Proxies (addresses or CIDRs) whose X-Forwarded-For entries are believed: nginx on this host,
+# plus the load balancer's subnet when there is one (e.g. the default VPC, 172.31.0.0/16)
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.environ.get('TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if proxy.strip()
+]
 
 # Razorpay configuration
 RAZORPAY_KEY_ID = os.environ.get('RAZORPAY_KEY_ID')
 RAZORPAY_KEY_SECRET = os.environ.get('RAZORPAY_KEY_SECRET')
+RAZORPAY_WEBHOOK_SECRET = os.environ.get('RAZORPAY_WEBHOOK_SECRET')
+
+# Payment reconciliation
+RECONCILE_INTERVAL_MINUTES = int(os.environ.get('RECONCILE_INTERVAL_MINUTES', '30'))
+RECONCILE_BATCH_SIZE = int(os.environ.get('RECONCILE_BATCH_SIZE', '1000'))
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '8'))
+# Unpaid orders younger than this may still be in checkout; older than the lookback are abandoned
+RECONCILE_STALE_MINUTES = int(os.environ.get('RECONCILE_STALE_MINUTES', '15'))
+RECONCILE_LOOKBACK_DAYS = int(os.environ.get('RECONCILE_LOOKBACK_DAYS', '3'))
+# "razorpay" asks Razorpay for order status; "local" is a stand-in that reports every order unpaid
+RECONCILE_PROVIDER = os.environ.get('RECONCILE_PROVIDER', 'razorpay')
+# "on" wraps the payment transition and listing activation in a multi-document transaction
+# (replica set / Atlas), "auto" detects support. The default outbox flag is just as crash-safe
+# and saves the commit round trip.
+PAYMENT_TRANSACTIONS = os.environ.get('PAYMENT_TRANSACTIONS', 'off')
 
 # AWS S3 configuration
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
@@ -58,6 +300,909 @@ AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
 S3_REGION = os.environ.get('S3_REGION', 'us-east-1')
 
+# Media configuration
+UPLOADS_DIR = os.environ.get('UPLOADS_DIR', '/app/uploads')
+IMAGE_VARIANT_CACHE_DIR = os.environ.get('IMAGE_VARIANT_CACHE_DIR', os.path.join(UPLOADS_DIR, '.variants'))
+IMAGE_VARIANT_CACHE_MAX_MB = int(os.environ.get('IMAGE_VARIANT_CACHE_MAX_MB', '512'))
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+IMAGE_VARIANT_WIDTHS = (160, 320, 640, 960, 1280, 1920)
+IMAGE_VARIANT_QUALITY = int(os.environ.get('IMAGE_VARIANT_QUALITY', '75'))
+# fmt query value -> (Pillow format, media type, file extension)
+IMAGE_VARIANT_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "jpg": ("JPEG", "image/jpeg", "jpg"),
+    "webp": ("WEBP", "image/webp", "webp"),
+}
+RESIZABLE_IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "gif", "bmp", "tiff", "heic", "heif"}
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', '2048'))
+IMAGE_INGEST_FORMAT = os.environ.get('IMAGE_INGEST_FORMAT', 'jpeg').lower()
+IMAGE_INGEST_QUALITY = int(os.environ.get('IMAGE_INGEST_QUALITY', '82'))
+IMAGE_ARCHIVE_ORIGINALS = os.environ.get('IMAGE_ARCHIVE_ORIGINALS', 'false').lower() == 'true'
+IMAGE_ARCHIVE_DIR = os.environ.get('IMAGE_ARCHIVE_DIR', os.path.join(UPLOADS_DIR, '.originals'))
+IMAGE_PLACEHOLDER_SIZE = 16
+
+# Video processing configuration (ffmpeg/ffprobe binaries are the only requirement)
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+FFPROBE_BINARY = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+FFMPEG_TIMEOUT_SECONDS = int(os.environ.get('FFMPEG_TIMEOUT_SECONDS', '300'))
+VIDEO_POSTER_MAX_WIDTH = 1280
+FASTSTART_CONTAINERS = {"mp4", "m4v", "mov"}
+
+# Background job queue configuration
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '300'))
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get('JOB_POLL_INTERVAL_SECONDS', '1.0'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_BACKOFF_BASE_SECONDS = int(os.environ.get('JOB_BACKOFF_BASE_SECONDS', '10'))
+JOB_BACKOFF_MAX_SECONDS = int(os.environ.get('JOB_BACKOFF_MAX_SECONDS', '3600'))
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', '7'))
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', '2'))
+# Run queue workers inside the API process instead of a separate `python server.py worker`
+JOB_WORKER_IN_PROCESS = os.environ.get('JOB_WORKER_IN_PROCESS', 'false').lower() == 'true'
+# Uploaded filenames are unique per upload, so originals and variants never change
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Logging
+# Records are rendered as JSON lines and written to stdout by a background thread, so a slow
+# log consumer (pm2) never blocks the event loop or a worker thread. When the queue is full,
+# records are dropped and counted rather than waited on.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+# Fraction of high-volume per-request events (OTP sends, payment steps, uploads) that are logged
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+# The ASGI scope of the request being handled (or {"job": ...} inside a job)
+request_scope_var = contextvars.ContextVar("request_scope", default=None)
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+class RequestContextFilter(logging.Filter):
+    """Drops unsampled records and stamps the request ID
+
+    Attached to the QueueHandler, so it runs in handle() on the thread that made the log
+    call; that is what lets it read the caller's request-ID contextvar.
+    """
+
+    def filter(self, record):
+        sample_rate = getattr(record, "sample_rate", 1.0)
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return False
+        record.request_id = request_id_var.get()
+        return True
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """Hand records to the writer thread without ever blocking the caller"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve args and the traceback now; everything else stays structured for the formatter
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def log_fields(sample_rate=None, **fields):
+    """`extra=` for a log call: structured fields, and optionally a sampling rate"""
+    extra = {"fields": fields}
+    if sample_rate is not None:
+        extra["sample_rate"] = sample_rate
+    return extra
+
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(JsonLogFormatter())
+log_handler = BackgroundLogHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_handler.addFilter(RequestContextFilter())
+log_listener = logging.handlers.QueueListener(log_handler.queue, _log_stream_handler)
+log_listener.start()
+# Drain queued records on interpreter exit
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger("onlylands")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(log_handler)
+logger.propagate = False
+
+class RequestIdMiddleware:
+    """Tag each request with an ID (the caller's X-Request-ID if sane) for log correlation"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = next((value.decode("latin-1") for key, value in scope["headers"] if key == b"x-request-id"), "")
+        request_id = incoming if 0 < len(incoming) <= 64 and incoming.replace("-", "").isalnum() else uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        # Routing adds the matched route to this same scope dict, so code running later
+        # in the request (e.g. the Mongo listener) can attribute itself to the route template
+        scope_token = request_scope_var.set(scope)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"x-request-id", request_id.encode())])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+            request_scope_var.reset(scope_token)
+
+# Metrics
+# Recorded in-process and scraped from /metrics in the Prometheus text format. Each process
+# (API, `server.py worker`) keeps its own registry; only the API process serves it.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class MetricsRegistry:
+    """Counters, gauges and fixed-bucket histograms keyed by name and label values"""
+
+    def __init__(self):
+        self.descriptions = {}
+        self.values = {}
+        self.histograms = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self.descriptions[name] = (metric_type, help_text, buckets)
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple((labels or {}).items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, labels=None, value=0):
+        key = (name, tuple((labels or {}).items()))
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, labels, value):
+        buckets = self.descriptions[name][2]
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def register_collector(self, collector):
+        """Call `collector()` at scrape time to refresh gauges derived from other state"""
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception:
+                logger.exception("Metrics collector failed")
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+
+        lines = []
+        for name in sorted(self.descriptions):
+            metric_type, help_text, buckets = self.descriptions[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', repr(float(bound))),))} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+metrics = MetricsRegistry()
+metrics.describe("onlylands_http_requests_total", "counter", "HTTP requests by route, method and status")
+metrics.describe("onlylands_http_request_duration_seconds", "histogram", "HTTP request latency by route", LATENCY_BUCKETS)
+metrics.describe("onlylands_http_response_size_bytes", "histogram", "HTTP response body size by route", SIZE_BUCKETS)
+metrics.describe("onlylands_http_requests_in_flight", "gauge", "HTTP requests currently being handled")
+metrics.describe("onlylands_mongo_command_duration_seconds", "histogram", "MongoDB command latency by collection", LATENCY_BUCKETS)
+metrics.describe("onlylands_mongo_command_errors_total", "counter", "Failed MongoDB commands by collection and error code")
+metrics.describe("onlylands_provider_call_duration_seconds", "histogram", "External provider call latency", LATENCY_BUCKETS)
+metrics.describe("onlylands_provider_calls_total", "counter", "External provider calls by outcome (ok or error code)")
+metrics.describe("onlylands_circuit_breaker_state", "gauge", "Circuit breaker state: 0 closed, 1 half open, 2 open")
+metrics.describe("onlylands_circuit_breaker_trips_total", "counter", "Times a circuit breaker has opened")
+metrics.describe("onlylands_log_records_dropped_total", "counter", "Log records dropped because the log queue was full")
+metrics.describe("onlylands_log_queue_depth", "gauge", "Log records waiting for the writer thread")
+
+def collect_log_metrics():
+    metrics.set("onlylands_log_records_dropped_total", None, log_handler.dropped)
+    metrics.set("onlylands_log_queue_depth", None, log_handler.queue.qsize())
+
+metrics.register_collector(collect_log_metrics)
+
+class MetricsMiddleware:
+    """Record count, latency and response size per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        started = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_with_metrics(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        metrics.inc("onlylands_http_requests_in_flight", {"method": method})
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            metrics.inc("onlylands_http_requests_in_flight", {"method": method}, -1)
+            # Routing stores the matched route in the scope; templates keep label cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            labels = {"route": route, "method": method}
+            metrics.inc("onlylands_http_requests_total", dict(labels, status=str(status)))
+            metrics.observe("onlylands_http_request_duration_seconds", labels, time.perf_counter() - started)
+            metrics.observe("onlylands_http_response_size_bytes", labels, size)
+
+
+# Request tracing
+# Each request carries a trace that collects timed spans (Mongo commands, provider and storage
+# calls, media work, serialization, compression, request body). Sampled and slow traces are kept
+# in a ring buffer for admins. The Server-Timing header exposes backend timings to any client, so
+# it is opt-in (e.g. for staging or local profiling).
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'true').lower() == 'true'
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', 'false').lower() == 'true'
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+# Traces slower than this are always kept
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '1000'))
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', '200'))
+TRACE_MAX_SPANS = 200
+
+current_trace_var = contextvars.ContextVar("current_trace", default=None)
+
+class RequestTrace:
+    """Spans recorded while one request is handled (appended from any thread it uses)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, category, name, started, duration):
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((category, name, started - self.started, duration))
+        else:
+            self.dropped += 1
+
+    def server_timing(self):
+        """Server-Timing value: total time per span category, plus the request so far"""
+        totals = {}
+        for category, _, _, duration in list(self.spans):
+            total, count = totals.get(category, (0.0, 0))
+            totals[category] = (total + duration, count + 1)
+        entries = [
+            f'{category};dur={total * 1000:.1f};desc="{count} spans"'
+            for category, (total, count) in sorted(totals.items())
+        ]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+def record_span(category, name, started, duration):
+    trace = current_trace_var.get()
+    if trace is not None:
+        trace.add(category, name, started, duration)
+
+@contextmanager
+def trace_span(category, name):
+    """Time a block as a span of the current request's trace (no-op outside requests)"""
+    if current_trace_var.get() is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(category, name, started, time.perf_counter() - started)
+
+recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+
+class TracingMiddleware:
+    """Open a trace per request, emit Server-Timing and keep sampled or slow traces"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        trace = RequestTrace()
+        token = current_trace_var.set(trace)
+        status = 500
+        body_started = None
+
+        async def receive_with_timing():
+            # Time spent receiving the request body (large multipart uploads show up here)
+            nonlocal body_started
+            message = await receive()
+            if message["type"] == "http.request":
+                if body_started is None:
+                    body_started = time.perf_counter()
+                if not message.get("more_body", False):
+                    trace.add("body", "request.body", body_started, time.perf_counter() - body_started)
+            return message
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING_HEADER:
+                    headers = list(message.get("headers", [])) + [(b"server-timing", trace.server_timing().encode())]
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_with_timing, send_with_timing)
+        finally:
+            current_trace_var.reset(token)
+            duration_ms = (time.perf_counter() - trace.started) * 1000
+            if duration_ms >= TRACE_SLOW_MS or random.random() < TRACE_SAMPLE_RATE:
+                recent_traces.append({
+                    "at": datetime.utcnow(),
+                    "request_id": request_id_var.get(),
+                    "method": scope["method"],
+                    "route": getattr(scope.get("route"), "path", "unmatched"),
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": round(duration_ms, 2),
+                    "spans": [
+                        {"category": category, "name": name,
+                         "start_ms": round(offset * 1000, 2), "duration_ms": round(duration * 1000, 2)}
+                        for category, name, offset, duration in trace.spans
+                    ],
+                    "dropped_spans": trace.dropped,
+                })
+
+
+# MongoDB query profiler
+# Every command is reduced to a shape (collection, operation, filter with values stripped) with
+# rolling latency percentiles; commands slower than the threshold are kept with their filter
+# and an explain summary computed on a background thread.
+MONGO_PROFILER_ENABLED = os.environ.get('MONGO_PROFILER_ENABLED', 'true').lower() == 'true'
+MONGO_SLOW_MS = float(os.environ.get('MONGO_SLOW_MS', '100'))
+MONGO_PROFILER_WINDOW = int(os.environ.get('MONGO_PROFILER_WINDOW', '500'))
+MONGO_PROFILER_MAX_SHAPES = int(os.environ.get('MONGO_PROFILER_MAX_SHAPES', '1000'))
+MONGO_SLOW_OPS_KEPT = int(os.environ.get('MONGO_SLOW_OPS_KEPT', '200'))
+# Explain each slow shape at most this often; explain runs the query planner again
+MONGO_EXPLAIN_INTERVAL_SECONDS = int(os.environ.get('MONGO_EXPLAIN_INTERVAL_SECONDS', '600'))
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "findAndModify", "update", "delete"}
+# Session, transaction and routing fields that explain rejects or that don't describe the query
+NON_QUERY_COMMAND_FIELDS = {
+    "lsid", "$db", "$clusterTime", "txnNumber", "autocommit", "startTransaction",
+    "$readPreference", "readConcern", "writeConcern", "apiVersion", "apiStrict", "apiDeprecationErrors",
+}
+
+def current_route():
+    """Route template (or job type) the calling code is running for"""
+    scope = request_scope_var.get()
+    if scope is None:
+        return "-"
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    return scope.get("job", "unmatched")
+
+def command_filter(command_name, command):
+    """The query part of a command, where it has one"""
+    if command_name == "find":
+        return command.get("filter", {})
+    if command_name in ("count", "distinct", "findAndModify"):
+        return command.get("query", {})
+    if command_name == "aggregate":
+        return [stage for stage in command.get("pipeline", []) if "$match" in stage or "$lookup" in stage]
+    if command_name == "update":
+        return [update.get("q") for update in command.get("updates", [])[:1]]
+    if command_name == "delete":
+        return [delete.get("q") for delete in command.get("deletes", [])[:1]]
+    return None
+
+def query_shape(value):
+    """Strip values from a filter, keeping field names and operators"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = query_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return "?"
+
+def command_shape(command_name, command):
+    """(filter, shape key) for a command; the shape is the filter with values stripped"""
+    query = command_filter(command_name, command)
+    if query is None:
+        return None, ""
+    return query, orjson.dumps(query_shape(query), option=orjson.OPT_SORT_KEYS).decode()
+
+def summarize_explain(result):
+    """Winning plan stages and indexes from explain output (find, aggregate or write commands)"""
+    def find_planner(node):
+        if isinstance(node, dict):
+            if "queryPlanner" in node:
+                return node["queryPlanner"]
+            for item in node.values():
+                found = find_planner(item)
+                if found:
+                    return found
+        elif isinstance(node, list):
+            for item in node:
+                found = find_planner(item)
+                if found:
+                    return found
+        return None
+
+    planner = find_planner(result) or {}
+    plan = planner.get("winningPlan", {})
+    # Slot-based execution nests the classic plan under queryPlan
+    plan = plan.get("queryPlan", plan)
+    stages, indexes = [], []
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        if not isinstance(node, dict):
+            continue
+        if node.get("stage"):
+            stages.append(node["stage"])
+        if node.get("indexName"):
+            indexes.append(node["indexName"])
+        pending.extend(node.get("inputStages", []))
+        if "inputStage" in node:
+            pending.append(node["inputStage"])
+    return {
+        "stages": stages,
+        "indexes": indexes,
+        "collection_scan": "COLLSCAN" in stages,
+        "rejected_plans": len(planner.get("rejectedPlans", [])),
+    }
+
+class QueryProfiler:
+    """Rolling per-shape latency percentiles plus a ring buffer of slow operations"""
+
+    def __init__(self):
+        self.shapes = OrderedDict()
+        self.slow_ops = deque(maxlen=MONGO_SLOW_OPS_KEPT)
+        self.explained_at = {}
+        self.lock = threading.Lock()
+        self.explain_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongo-explain")
+
+    def record(self, database, collection, command_name, command, query, shape, duration_ms):
+        if command_name == "explain":
+            return
+        key = (collection, command_name, shape)
+        route = current_route()
+        with self.lock:
+            stats = self.shapes.get(key)
+            if stats is None:
+                stats = self.shapes[key] = {
+                    "durations": deque(maxlen=MONGO_PROFILER_WINDOW), "count": 0, "total_ms": 0.0, "routes": {}
+                }
+                while len(self.shapes) > MONGO_PROFILER_MAX_SHAPES:
+                    self.shapes.popitem(last=False)
+            else:
+                self.shapes.move_to_end(key)
+            stats["durations"].append(duration_ms)
+            stats["count"] += 1
+            stats["total_ms"] += duration_ms
+            if route in stats["routes"] or len(stats["routes"]) < 20:
+                stats["routes"][route] = stats["routes"].get(route, 0) + 1
+
+        if duration_ms < MONGO_SLOW_MS:
+            return
+        slow_op = {
+            "at": datetime.utcnow(),
+            "collection": collection,
+            "operation": command_name,
+            "shape": shape,
+            # Detached from the driver's command and made JSON-safe (ObjectId, regex, binary)
+            "filter": orjson.loads(orjson.dumps(query, default=str)),
+            "duration_ms": round(duration_ms, 2),
+            "route": route,
+            "request_id": request_id_var.get(),
+            "explain": None,
+        }
+        with self.lock:
+            self.slow_ops.append(slow_op)
+            due = time.monotonic() - self.explained_at.get(key, -MONGO_EXPLAIN_INTERVAL_SECONDS) >= MONGO_EXPLAIN_INTERVAL_SECONDS
+            if due and command_name in EXPLAINABLE_COMMANDS:
+                self.explained_at[key] = time.monotonic()
+            else:
+                due = False
+        if due:
+            explain_command = {name: value for name, value in command.items() if name not in NON_QUERY_COMMAND_FIELDS}
+            self.explain_pool.submit(self.explain, database, explain_command, slow_op)
+
+    def explain(self, database, command, slow_op):
+        try:
+            result = client[database].command({"explain": command, "verbosity": "queryPlanner"})
+            slow_op["explain"] = summarize_explain(result)
+        except Exception as e:
+            slow_op["explain"] = {"error": str(e)[:200]}
+
+    def report(self, limit=50):
+        def percentile(sorted_values, fraction):
+            return round(sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))], 2)
+
+        with self.lock:
+            snapshot = [(key, list(stats["durations"]), stats["count"], stats["total_ms"], dict(stats["routes"]))
+                        for key, stats in self.shapes.items()]
+            slow_ops = list(self.slow_ops)
+        shapes = []
+        for (collection, operation, shape), durations, count, total_ms, routes in snapshot:
+            durations.sort()
+            shapes.append({
+                "collection": collection,
+                "operation": operation,
+                "shape": shape,
+                "count": count,
+                "total_ms": round(total_ms, 2),
+                "p50_ms": percentile(durations, 0.50),
+                "p95_ms": percentile(durations, 0.95),
+                "p99_ms": percentile(durations, 0.99),
+                "max_ms": round(durations[-1], 2),
+                "routes": routes,
+            })
+        shapes.sort(key=lambda item: item["p95_ms"], reverse=True)
+        return {
+            "slow_threshold_ms": MONGO_SLOW_MS,
+            "shapes": shapes[:limit],
+            "slow_operations": list(reversed(slow_ops))[:limit],
+        }
+
+query_profiler = QueryProfiler()
+
+# Database round-trip budgets
+# Every request counts its Mongo queries and query shapes. A cursor's getMore batches belong to
+# the query that opened it, so budgets hold however large a result grows. Going over the route's budget
+# (declared with @db_budget, else DB_DEFAULT_BUDGET) or repeating one shape DB_REPEAT_THRESHOLD
+# times (an N+1 loop) is logged in "warn" mode and turned into a 500 in "strict" mode (tests).
+DB_BUDGET_MODE = os.environ.get('DB_BUDGET_MODE', 'warn').lower()
+DB_DEFAULT_BUDGET = int(os.environ.get('DB_DEFAULT_BUDGET', '10'))
+DB_REPEAT_THRESHOLD = int(os.environ.get('DB_REPEAT_THRESHOLD', '5'))
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+metrics.describe("onlylands_db_round_trips_per_request", "histogram", "MongoDB round trips per request by route", ROUND_TRIP_BUCKETS)
+metrics.describe("onlylands_db_budget_violations_total", "counter", "Requests over their round-trip budget or repeating a query shape")
+
+db_usage_var = contextvars.ContextVar("db_usage", default=None)
+
+def db_budget(round_trips, repeats=None):
+    """Declare how many MongoDB queries a route may make per request
+
+    `repeats` raises the repeated-shape threshold for routes that deliberately run one
+    bounded query per item of a capped batch.
+    """
+    def declare(endpoint):
+        endpoint.db_budget = round_trips
+        endpoint.db_repeat_threshold = repeats or DB_REPEAT_THRESHOLD
+        return endpoint
+    return declare
+
+class RequestDbUsage:
+    """Round trips and query shapes seen by one request (possibly from several threads)"""
+
+    def __init__(self):
+        self.round_trips = 0
+        self.cursor_batches = 0
+        self.shapes = {}
+        self.lock = threading.Lock()
+
+    def record(self, collection, command_name, shape):
+        with self.lock:
+            if command_name == "getMore":
+                # Draining a cursor is part of the query that opened it
+                self.cursor_batches += 1
+                return
+            key = (collection, command_name, shape)
+            self.round_trips += 1
+            self.shapes[key] = self.shapes.get(key, 0) + 1
+
+    def violations(self, budget, repeat_threshold=DB_REPEAT_THRESHOLD):
+        found = []
+        if self.round_trips > budget:
+            found.append({"kind": "budget", "detail": f"{self.round_trips} queries, budget {budget}"})
+        for (collection, command_name, shape), count in self.shapes.items():
+            if count >= repeat_threshold:
+                found.append({"kind": "repeated_shape", "detail": f"{command_name} {collection} {shape} x{count}"})
+        return found
+
+class DbBudgetMiddleware:
+    """Report round trips in X-DB-Round-Trips and enforce per-route budgets"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or DB_BUDGET_MODE == "off":
+            await self.app(scope, receive, send)
+            return
+        usage = RequestDbUsage()
+        token = db_usage_var.set(usage)
+        replaced = False
+
+        async def send_with_budget(message):
+            nonlocal replaced
+            if replaced:
+                return
+            if message["type"] == "http.response.start":
+                route = scope.get("route")
+                route_path = getattr(route, "path", "unmatched")
+                endpoint = getattr(route, "endpoint", None)
+                budget = getattr(endpoint, "db_budget", DB_DEFAULT_BUDGET)
+                repeat_threshold = getattr(endpoint, "db_repeat_threshold", DB_REPEAT_THRESHOLD)
+                metrics.observe("onlylands_db_round_trips_per_request", {"route": route_path}, usage.round_trips)
+                violations = usage.violations(budget, repeat_threshold)
+                round_trips_header = (b"x-db-round-trips", str(usage.round_trips).encode())
+                if violations:
+                    for violation in violations:
+                        metrics.inc("onlylands_db_budget_violations_total", {"route": route_path, "kind": violation["kind"]})
+                    logger.warning(
+                        "Database round-trip budget exceeded",
+                        extra=log_fields(route=route_path, round_trips=usage.round_trips, violations=violations)
+                    )
+                    if DB_BUDGET_MODE == "strict":
+                        replaced = True
+                        body = orjson.dumps({"detail": "Database round-trip budget exceeded", "violations": violations})
+                        await send({"type": "http.response.start", "status": 500, "headers": [
+                            (b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()),
+                            round_trips_header,
+                        ]})
+                        await send({"type": "http.response.body", "body": body})
+                        return
+                message = dict(message, headers=list(message.get("headers", [])) + [round_trips_header])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_budget)
+        finally:
+            db_usage_var.reset(token)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Time every MongoDB command per collection (pymongo calls these on the calling thread)"""
+
+    def __init__(self):
+        self.pending = {}
+
+    def started(self, event):
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        else:
+            collection = event.command.get(event.command_name)
+        collection = collection if isinstance(collection, str) else "-"
+        # Keep the command itself only while the profiler or round-trip budgets need its filter
+        command = event.command if MONGO_PROFILER_ENABLED or DB_BUDGET_MODE != "off" else None
+        self.pending[(event.connection_id, event.request_id)] = (collection, command, event.database_name)
+
+    def succeeded(self, event):
+        self.finish(event)
+
+    def failed(self, event):
+        collection = self.finish(event)
+        code = event.failure.get("code", "unknown") if isinstance(event.failure, dict) else "unknown"
+        metrics.inc("onlylands_mongo_command_errors_total", {
+            "collection": collection, "command": event.command_name, "code": str(code)
+        })
+
+    def finish(self, event):
+        collection, command, database = self.pending.pop((event.connection_id, event.request_id), ("-", None, None))
+        duration = event.duration_micros / 1_000_000
+        metrics.observe(
+            "onlylands_mongo_command_duration_seconds",
+            {"collection": collection, "command": event.command_name},
+            duration
+        )
+        record_span("db", f"{event.command_name} {collection}", time.perf_counter() - duration, duration)
+        if command is None:
+            return collection
+        try:
+            query, shape = command_shape(event.command_name, command)
+            if MONGO_PROFILER_ENABLED:
+                query_profiler.record(
+                    database, collection, event.command_name, command, query, shape, event.duration_micros / 1000
+                )
+            usage = db_usage_var.get()
+            if usage is not None:
+                usage.record(collection, event.command_name, shape)
+        except Exception as e:
+            logger.warning("Query profiler failed to record command", extra=log_fields(command=event.command_name, error=str(e)))
+        return collection
+
+mongo_command_metrics = MongoCommandMetrics()
+
+# Observability middleware, innermost first: each add_middleware wraps the ones added before it
+app.add_middleware(DbBudgetMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+# Outermost, so the request ID is set before any other middleware logs or traces
+app.add_middleware(RequestIdMiddleware)
+
+# Event loop watchdog
+# Opt-in (meant for staging): a heartbeat task measures how late the loop wakes it, while a
+# watcher thread samples the loop thread's stack during a stall and matches its frames against
+# route endpoints, so a blocking call added to an async route shows up under that route.
+LOOP_WATCHDOG_ENABLED = os.environ.get('LOOP_WATCHDOG_ENABLED', 'false').lower() == 'true'
+LOOP_STALL_THRESHOLD_MS = float(os.environ.get('LOOP_STALL_THRESHOLD_MS', '100'))
+LOOP_WATCHDOG_STACK_DEPTH = 25
+STALL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+metrics.describe("onlylands_event_loop_stalls_total", "counter", "Event loop stalls above the threshold by route")
+metrics.describe("onlylands_event_loop_stall_seconds", "histogram", "Event loop stall duration by route", STALL_BUCKETS)
+
+class EventLoopWatchdog:
+    def __init__(self, threshold_seconds):
+        self.threshold = threshold_seconds
+        self.interval = threshold_seconds / 4
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.captured = None
+        self.code_routes = {}
+        self.stop_event = threading.Event()
+        self.heartbeat_task = None
+
+    def start(self, routes):
+        """Start watching the running loop; call from a coroutine on that loop"""
+        # Unwrap decorated endpoints so the frame on the stack is the route's own function
+        self.code_routes = {}
+        for route in routes:
+            endpoint = getattr(route, "endpoint", None)
+            code = getattr(inspect.unwrap(endpoint), "__code__", None) if endpoint is not None else None
+            if code is not None:
+                self.code_routes[code] = route.path
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, daemon=True, name="loop-watchdog").start()
+        logger.info("Event loop watchdog started", extra=log_fields(threshold_ms=self.threshold * 1000))
+
+    def stop(self):
+        self.stop_event.set()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+
+    async def heartbeat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            woke = time.monotonic()
+            self.last_beat = woke
+            lag = woke - before - self.interval
+            if lag >= self.threshold:
+                self.report(lag)
+
+    def watch(self):
+        while not self.stop_event.wait(self.interval):
+            stalled_for = time.monotonic() - self.last_beat - self.interval
+            if self.captured is None and stalled_for >= self.threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self.captured = (self.attribute(frame), traceback.format_stack(frame)[-LOOP_WATCHDOG_STACK_DEPTH:])
+
+    def attribute(self, frame):
+        """Route whose endpoint is on the stalled stack, innermost first"""
+        while frame is not None:
+            route = self.code_routes.get(frame.f_code)
+            if route is not None:
+                return route
+            frame = frame.f_back
+        return "unattributed"
+
+    def report(self, lag):
+        captured, self.captured = self.captured, None
+        # A stall shorter than the watcher's sampling interval ends before a stack is taken
+        route, stack = captured or ("unattributed", [])
+        metrics.inc("onlylands_event_loop_stalls_total", {"route": route})
+        metrics.observe("onlylands_event_loop_stall_seconds", {"route": route}, lag)
+        logger.warning(
+            "Event loop stalled",
+            extra=log_fields(route=route, stall_ms=round(lag * 1000, 1), stack="".join(stack))
+        )
+
+loop_watchdog = EventLoopWatchdog(LOOP_STALL_THRESHOLD_MS / 1000)
+
+@app.on_event("startup")
+async def start_loop_watchdog():
+    if LOOP_WATCHDOG_ENABLED:
+        loop_watchdog.start(app.routes)
+
+@app.on_event("shutdown")
+def stop_loop_watchdog():
+    loop_watchdog.stop()
+
+def provider_error_code(error):
+    """Short, low-cardinality label for a failed provider call"""
+    if isinstance(error, TwilioRestException):
+        return str(error.code or error.status)
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code", "ClientError")
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if error.__class__.__name__ == "CircuitOpenError":
+        return "circuit_open"
+    return type(error).__name__
+
+@contextmanager
+def track_provider_call(provider, operation):
+    """Record latency and outcome of a call to Twilio, Razorpay or storage"""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception as e:
+        outcome = provider_error_code(e)
+        raise
+    finally:
+        labels = {"provider": provider, "operation": operation}
+        elapsed = time.perf_counter() - started
+        metrics.observe("onlylands_provider_call_duration_seconds", labels, elapsed)
+        record_span(provider, operation, started, elapsed)
+        metrics.inc("onlylands_provider_calls_total", dict(labels, outcome=outcome))
+
 # Initialize services with error handling for MongoDB Atlas
 def connect_to_mongodb(max_retries=3):
     """Connect to MongoDB with retry logic"""
@@ -69,19 +1214,20 @@ def connect_to_mongodb(max_retries=3):
                 connectTimeoutMS=10000,         # 10 second connection timeout
                 socketTimeoutMS=5000,           # 5 second socket timeout
                 retryWrites=True,               # Enable retryable writes for Atlas
-                w='majority'                    # Write concern for Atlas
+                w='majority',                   # Write concern for Atlas
+                event_listeners=[mongo_command_metrics]
             )
             # Test the connection
             client.admin.command('ping')
-            print(f"✅ Successfully connected to MongoDB: {DB_NAME} (attempt {attempt + 1})")
+            logger.info("Successfully connected to MongoDB", extra=log_fields(database=DB_NAME, attempt=attempt + 1))
             return client, client[DB_NAME]
         except Exception as e:
-            print(f"❌ MongoDB connection attempt {attempt + 1} failed: {e}")
+            logger.warning("MongoDB connection attempt failed", extra=log_fields(attempt=attempt + 1, error=str(e)))
             if attempt < max_retries - 1:
-                print(f"⏳ Retrying in 2 seconds...")
+                logger.info("Retrying in 2 seconds...")
                 time.sleep(2)
             else:
-                print(f"❌ Failed to connect to MongoDB after {max_retries} attempts")
+                logger.error("Failed to connect to MongoDB", extra=log_fields(attempts=max_retries))
                 return None, None
 
 # Connect to MongoDB
@@ -89,9 +1235,13 @@ client, db = connect_to_mongodb()
 
 security = HTTPBearer()
 
-# Initialize Twilio
+# Initialize Twilio (bounded HTTP timeout so a hung call cannot pin a worker thread)
 if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    twilio_client = Client(
+        TWILIO_ACCOUNT_SID,
+        TWILIO_AUTH_TOKEN,
+        http_client=TwilioHttpClient(timeout=TWILIO_TIMEOUT_SECONDS)
+    )
 else:
     twilio_client = None
 
@@ -112,6 +1262,282 @@ if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
 else:
     s3_client = None
 
+# Provider circuit breakers
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open"""
+
+class CircuitBreaker:
+    """Fail fast while a provider keeps erroring
+
+    The breaker opens after `failure_threshold` consecutive failures. Once `reset_timeout`
+    seconds have passed it lets a single trial call through (half open); that call either
+    closes the breaker again or re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self.trial_in_flight = False
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_ignored(self):
+        """A call that failed for its own reasons says nothing about provider health
+
+        The state and failure streak are left as they are; only a half-open trial slot is
+        released so the next call can probe again.
+        """
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self.lock:
+            return {"state": self.state, "consecutive_failures": self.failures, "trips": self.trips}
+
+twilio_breaker = CircuitBreaker("twilio", TWILIO_BREAKER_FAILURE_THRESHOLD, TWILIO_BREAKER_RESET_SECONDS)
+
+BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+def collect_breaker_metrics():
+    for breaker in (twilio_breaker,):
+        snapshot = breaker.snapshot()
+        metrics.set("onlylands_circuit_breaker_state", {"breaker": breaker.name}, BREAKER_STATE_VALUES[snapshot["state"]])
+        metrics.set("onlylands_circuit_breaker_trips_total", {"breaker": breaker.name}, snapshot["trips"])
+
+metrics.register_collector(collect_breaker_metrics)
+
+def is_twilio_outage(error):
+    """Errors that say Twilio is unhealthy or throttling us, as opposed to a bad request"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError)):
+        return True
+    if isinstance(error, TwilioRestException):
+        return error.code == 20429 or error.status == 429 or (error.status or 0) >= 500
+    return "20429" in str(error)
+
+async def call_twilio(func, *args, **kwargs):
+    """Run a blocking Twilio SDK call off the event loop with a deadline and circuit breaker"""
+    if not twilio_breaker.allow():
+        raise CircuitOpenError("Twilio circuit breaker is open")
+    try:
+        with track_provider_call("twilio", func.__qualname__):
+            result = await asyncio.wait_for(asyncio.to_thread(func, *args, **kwargs), TWILIO_TIMEOUT_SECONDS)
+    except Exception as e:
+        if is_twilio_outage(e):
+            twilio_breaker.record_failure()
+        else:
+            twilio_breaker.record_ignored()
+        raise
+    twilio_breaker.record_success()
+    return result
+
+# Rate limiting
+class TokenBucketLimiter:
+    """In-process token buckets keyed by string, refilled continuously"""
+
+    def __init__(self, name, spec, max_keys=100000):
+        capacity, period = spec.split('/')
+        self.name = name
+        self.capacity = float(capacity)
+        self.period = float(period)
+        self.rate = self.capacity / self.period
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a token; return 0 when allowed, otherwise seconds until one is available"""
+        now = time.monotonic()
+        with self.lock:
+            if key not in self.buckets and len(self.buckets) >= self.max_keys:
+                self.evict_refilled(now)
+                if len(self.buckets) >= self.max_keys:
+                    # Every tracked bucket is still draining and forgetting one would hand its
+                    # key a fresh allowance, so new keys wait until the oldest has refilled
+                    tokens, updated = next(iter(self.buckets.values()))
+                    return max((self.capacity - tokens) / self.rate - (now - updated), 1 / self.rate)
+            tokens, updated = self.buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self.buckets[key] = (tokens, now)
+            return wait
+
+    def evict_refilled(self, now):
+        """Drop least recently used buckets that have refilled; a full bucket is the same as none"""
+        while self.buckets:
+            tokens, updated = next(iter(self.buckets.values()))
+            if tokens + (now - updated) * self.rate < self.capacity:
+                break
+            self.buckets.popitem(last=False)
+
+    def refund(self, key):
+        """Give back a token taken for a request that another limit rejected"""
+        with self.lock:
+            if key in self.buckets:
+                tokens, updated = self.buckets[key]
+                self.buckets[key] = (min(self.capacity, tokens + 1), updated)
+
+    def acquire_shared(self, key):
+        """Take a token from the bucket shared by all workers through MongoDB"""
+        now = datetime.utcnow()
+        elapsed = {"$max": [0, {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}]}
+        refilled = {"$min": [self.capacity, {"$add": [{"$ifNull": ["$tokens", self.capacity]}, {"$multiply": [elapsed, self.rate]}]}]}
+        pipeline = [
+            {"$set": {"tokens": refilled, "updated_at": now}},
+            {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+            {"$set": {
+                "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                "expires_at": now + timedelta(seconds=self.period)
+            }}
+        ]
+        try:
+            bucket = db.rate_limits.find_one_and_update(
+                {"_id": f"{self.name}:{key}"}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another worker's upsert created the bucket first; this time the update matches it
+            bucket = db.rate_limits.find_one_and_update(
+                {"_id": f"{self.name}:{key}"}, pipeline, return_document=ReturnDocument.AFTER
+            )
+        if bucket["allowed"]:
+            return 0
+        return (1 - bucket["tokens"]) / self.rate
+
+    def refund_shared(self, key):
+        """Give back a token taken from the shared bucket"""
+        db.rate_limits.update_one(
+            {"_id": f"{self.name}:{key}"},
+            [{"$set": {"tokens": {"$min": [self.capacity, {"$add": ["$tokens", 1]}]}}}]
+        )
+
+otp_phone_limiter = TokenBucketLimiter("otp_phone", OTP_RATE_LIMIT_PHONE)
+otp_ip_limiter = TokenBucketLimiter("otp_ip", OTP_RATE_LIMIT_IP)
+otp_global_limiter = TokenBucketLimiter("otp_global", OTP_RATE_LIMIT_GLOBAL)
+
+def is_trusted_proxy(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+def get_client_ip(http_request):
+    """Address of the client that reached the first trusted proxy
+
+    X-Forwarded-For is read right to left, skipping hops that are trusted proxies; entries
+    further left were written by the client and can't be believed. Requests from a peer
+    that is not a trusted proxy are keyed on the peer itself, whatever headers they carry.
+    """
+    peer = http_request.client.host if http_request.client else "unknown"
+    if not is_trusted_proxy(peer):
+        return peer
+    hops = [hop.strip() for hop in http_request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+def enforce_otp_rate_limits(phone_number, client_ip):
+    """Reject an OTP request with 429 + Retry-After before any provider call is made
+
+    A request is charged only if every limit allows it: tokens taken by the limits checked
+    before a rejection are refunded, so a flood blocked by one limit can't drain the others.
+    """
+    shared = OTP_RATE_LIMIT_BACKEND == "mongo" and db is not None
+    spent = []
+    for limiter, key, scope in (
+        (otp_phone_limiter, phone_number, "this phone number"),
+        (otp_ip_limiter, client_ip, "this network"),
+        (otp_global_limiter, "all", "the OTP service"),
+    ):
+        # The local bucket rejects floods cheaply; the shared one is authoritative across workers
+        wait = limiter.acquire(key)
+        if not wait:
+            spent.append((limiter.refund, key))
+            if shared:
+                wait = limiter.acquire_shared(key)
+                if not wait:
+                    spent.append((limiter.refund_shared, key))
+        if wait:
+            for refund, spent_key in spent:
+                refund(spent_key)
+            retry_after = max(1, math.ceil(wait))
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many OTP requests for {scope}. Please try again in {retry_after} seconds.",
+                headers={"Retry-After": str(retry_after)}
+            )
+
+# Seller phone cache
+class TTLCache:
+    """Small thread-safe key/value cache with per-entry expiry and LRU eviction"""
+
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+seller_phone_cache = TTLCache(SELLER_PHONE_CACHE_TTL_SECONDS, SELLER_PHONE_CACHE_MAX_ENTRIES)
+
 # Pydantic models
 class OTPRequest(BaseModel):
     phone_number: str
@@ -147,13 +1573,44 @@ def get_image_src(image_data):
     else:
         return None
 
+def location_keys(location):
+    """Normalized parts of a location string ("Nashik, Maharashtra" -> ["nashik", "maharashtra"])
+
+    Broker locations are several places joined with commas; each part is indexed so a
+    listing can match any one of them.
+    """
+    if not location:
+        return []
+    keys = []
+    for part in str(location).split(','):
+        key = " ".join(part.lower().split())
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+def listing_location_keys(location):
+    """Keys a listing is matched to brokers on: only its most specific part
+
+    "Nashik, Maharashtra" reaches brokers covering Nashik, not every broker in Maharashtra.
+    """
+    return location_keys(location)[:1]
+
+def to_e164(phone_number):
+    """Best-effort E.164 formatting; bare 10-digit numbers are assumed to be Indian"""
+    digits = "".join(ch for ch in phone_number if ch.isdigit())
+    if phone_number.strip().startswith('+'):
+        return f"+{digits}"
+    if len(digits) == 10:
+        return f"+91{digits}"
+    return f"+{digits}"
+
 def upload_to_s3(file_content, filename, content_type):
     """Upload file to local storage (mimicking S3) and return URL"""
     try:
         import os
         
         # Create uploads directory if it doesn't exist
-        uploads_dir = "/app/uploads"
+        uploads_dir = UPLOADS_DIR
         os.makedirs(uploads_dir, exist_ok=True)
         
         # Generate unique filename with timestamp
@@ -164,17 +1621,391 @@ def upload_to_s3(file_content, filename, content_type):
         file_path = os.path.join(uploads_dir, unique_filename)
         
         # Save file locally
-        with open(file_path, "wb") as f:
+        with track_provider_call("storage", "put"), open(file_path, "wb") as f:
             f.write(file_content)
         
         # Return local URL that will be served by the backend
         local_url = f"/api/uploads/{unique_filename}"
-        print(f"✅ File stored locally: {local_url}")
+        logger.debug("File stored locally", extra=log_fields(url=local_url))
         return local_url
         
+    except Exception:
+        logger.exception("Error storing file locally")
+        return None
+
+# Image variant helpers
+_media_pool = None
+
+def get_media_pool():
+    """Return the shared process pool used for CPU-heavy image work"""
+    global _media_pool
+    if _media_pool is None:
+        _media_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _media_pool
+
+SRGB_PROFILE = ImageCms.createProfile("sRGB")
+
+def convert_to_srgb(image, icc_profile):
+    """Convert pixels described by an embedded ICC profile (e.g. Display P3) to sRGB
+
+    Re-encoded images carry no profile and are shown as sRGB, so unconverted wide-gamut
+    pixels would shift colour. Unreadable profiles leave the image as it is.
+    """
+    if not icc_profile or image.mode not in ("RGB", "RGBA", "CMYK", "P"):
+        return image
+    if image.mode == "P":
+        image = image.convert("RGBA")
+    try:
+        source = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+        return ImageCms.profileToProfile(
+            image, source, SRGB_PROFILE, outputMode="RGBA" if image.mode == "RGBA" else "RGB"
+        )
+    except (ImageCms.PyCMSError, OSError, ValueError):
+        return image
+
+def has_transparency(image):
+    return "A" in image.getbands() or (image.mode == "P" and "transparency" in image.info)
+
+def flatten_to_rgb(image):
+    """RGB copy of an image with transparent areas on white rather than black"""
+    if not has_transparency(image):
+        return image.convert("RGB")
+    image = image.convert("RGBA")
+    background = Image.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel("A"))
+    return background
+
+def render_image_variant(source_path, target_path, width, image_format, quality):
+    """Resize an image to at most `width` pixels wide and save it (runs in the media pool)"""
+    with Image.open(source_path) as image:
+        icc_profile = image.info.get("icc_profile")
+        # Let the JPEG decoder downscale while decoding instead of inflating the full frame
+        image.draft("RGB", (width, width * 4))
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        image = convert_to_srgb(image, icc_profile)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = flatten_to_rgb(image)
+        elif image_format == "WEBP" and image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if has_transparency(image) else "RGB")
+        tmp_path = f"{target_path}.{os.getpid()}.tmp"
+        if image_format == "WEBP":
+            image.save(tmp_path, image_format, quality=quality, method=4)
+        else:
+            image.save(tmp_path, image_format, quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, target_path)
+    return os.path.getsize(target_path)
+
+def normalize_photo(content, max_edge, image_format, quality):
+    """Decode an uploaded photo, apply EXIF orientation, drop metadata, cap its size and re-encode it
+
+    Colours are converted to sRGB from any embedded profile, and transparency is flattened
+    onto white for formats without alpha. Runs in the media pool. Returns (encoded bytes,
+    file extension, placeholder data URI).
+    """
+    with Image.open(io.BytesIO(content)) as image:
+        icc_profile = image.info.get("icc_profile")
+        image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=3.0)
+        image = convert_to_srgb(image, icc_profile)
+        pil_format, _, extension = IMAGE_VARIANT_FORMATS[image_format]
+        if pil_format == "JPEG" or not has_transparency(image):
+            image = flatten_to_rgb(image)
+        else:
+            image = image.convert("RGBA")
+        output = io.BytesIO()
+        # Pixels are sRGB now, so dropping the exif/icc arguments leaves all metadata behind
+        if pil_format == "WEBP":
+            image.save(output, pil_format, quality=quality, method=4)
+        else:
+            image.save(output, pil_format, quality=quality, optimize=True, progressive=True)
+        placeholder = render_photo_placeholder(image)
+    return output.getvalue(), extension, placeholder
+
+def render_photo_placeholder(image):
+    """Encode a tiny blurred-up preview of an image as a data URI for instant grid painting"""
+    preview = flatten_to_rgb(image)
+    preview.thumbnail((IMAGE_PLACEHOLDER_SIZE, IMAGE_PLACEHOLDER_SIZE), Image.BILINEAR)
+    output = io.BytesIO()
+    preview.save(output, "JPEG", quality=40)
+    return f"data:image/jpeg;base64,{base64.b64encode(output.getvalue()).decode('ascii')}"
+
+def archive_original_photo(content, name):
+    """Keep the untouched upload outside the served uploads directory"""
+    try:
+        os.makedirs(IMAGE_ARCHIVE_DIR, exist_ok=True)
+        with open(os.path.join(IMAGE_ARCHIVE_DIR, name), "wb") as f:
+            f.write(content)
+        return name
+    except Exception:
+        logger.exception("Error archiving original photo")
+        return None
+
+async def ingest_photo(photo):
+    """Normalize an uploaded photo and store it, returning (url, placeholder, archived original name)"""
+    original = await photo.read()
+    original_extension = photo.filename.split('.')[-1]
+    photo_id = uuid.uuid4()
+    loop = asyncio.get_running_loop()
+    try:
+        with trace_span("media", "normalize_photo"):
+            content, extension, placeholder = await loop.run_in_executor(
+                get_media_pool(),
+                normalize_photo,
+                original,
+                IMAGE_MAX_EDGE,
+                IMAGE_INGEST_FORMAT,
+                IMAGE_INGEST_QUALITY
+            )
+        content_type = IMAGE_VARIANT_FORMATS[IMAGE_INGEST_FORMAT][1]
     except Exception as e:
-        print(f"❌ Error storing file locally: {e}")
+        # Keep formats Pillow cannot decode exactly as uploaded
+        logger.warning("Could not normalize photo, storing as uploaded", extra=log_fields(filename=photo.filename, error=str(e)))
+        content, extension, placeholder = original, original_extension, None
+        content_type = photo.content_type
+
+    archived = None
+    if IMAGE_ARCHIVE_ORIGINALS:
+        archived = await asyncio.to_thread(archive_original_photo, original, f"{photo_id}.{original_extension}")
+
+    photo_url = await asyncio.to_thread(upload_to_s3, content, f"photos/{photo_id}.{extension}", content_type)
+    return photo_url, placeholder, archived
+
+# Video processing helpers
+def ffmpeg_available():
+    """Check that the ffmpeg and ffprobe binaries can be found"""
+    return shutil.which(FFMPEG_BINARY) is not None and shutil.which(FFPROBE_BINARY) is not None
+
+def mp4_has_faststart(path):
+    """Return True when the moov atom precedes mdat, i.e. playback can start before the download ends"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box_type = struct.unpack(">I4s", header)
+            if box_type == b"moov":
+                return True
+            if box_type == b"mdat":
+                return False
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0]
+                f.seek(size - 16, os.SEEK_CUR)
+            elif size < 8:
+                # size 0 means "to end of file"; anything else is not a valid box
+                return False
+            else:
+                f.seek(size - 8, os.SEEK_CUR)
+
+def probe_video(path):
+    """Read duration and display resolution of a video with ffprobe"""
+    result = subprocess.run(
+        [FFPROBE_BINARY, "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height:stream_tags=rotate:stream_side_data=rotation:format=duration",
+         "-of", "json", path],
+        capture_output=True, check=True, timeout=FFMPEG_TIMEOUT_SECONDS
+    )
+    info = json.loads(result.stdout or b"{}")
+    stream = (info.get("streams") or [{}])[0]
+    width, height = stream.get("width"), stream.get("height")
+
+    # Phones record portrait video as rotated landscape frames
+    rotation = stream.get("tags", {}).get("rotate")
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    if rotation is not None and abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+
+    duration = info.get("format", {}).get("duration")
+    return {
+        "duration": round(float(duration), 2) if duration else None,
+        "width": width,
+        "height": height
+    }
+
+def remux_faststart(path, target_path):
+    """Write a copy of an MP4/MOV with the moov atom first, without re-encoding
+
+    The source is left untouched: it has already been served as immutable.
+    """
+    tmp_path = f"{target_path}.tmp.{target_path.rsplit('.', 1)[-1]}"
+    try:
+        subprocess.run(
+            [FFMPEG_BINARY, "-v", "error", "-y", "-i", path, "-map", "0", "-c", "copy",
+             "-movflags", "+faststart", tmp_path],
+            capture_output=True, check=True, timeout=FFMPEG_TIMEOUT_SECONDS
+        )
+        os.replace(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def extract_video_poster(path, poster_path, duration):
+    """Grab a representative frame as a JPEG poster"""
+    offset = min(1.0, duration / 2) if duration else 0
+    subprocess.run(
+        [FFMPEG_BINARY, "-v", "error", "-y", "-ss", f"{offset:.2f}", "-i", path,
+         "-frames:v", "1", "-vf", f"scale='min({VIDEO_POSTER_MAX_WIDTH},iw)':-2", "-q:v", "3", poster_path],
+        capture_output=True, check=True, timeout=FFMPEG_TIMEOUT_SECONDS
+    )
+
+def process_video(video_url):
+    """Remux a stored video for progressive playback and extract its poster and metadata"""
+    filename = video_url.rsplit('/', 1)[-1]
+    path = os.path.join(UPLOADS_DIR, filename)
+    meta = {"url": video_url}
+
+    meta.update(probe_video(path))
+
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension in FASTSTART_CONTAINERS:
+        if not mp4_has_faststart(path):
+            # Uploads are cached as immutable, so the remuxed file gets its own URL;
+            # the original stays in place for pages that already reference it
+            remuxed_name = f"{filename.rsplit('.', 1)[0]}_faststart.{filename.rsplit('.', 1)[-1]}"
+            remux_faststart(path, os.path.join(UPLOADS_DIR, remuxed_name))
+            path = os.path.join(UPLOADS_DIR, remuxed_name)
+            meta["url"] = f"/api/uploads/{remuxed_name}"
+            meta["original_url"] = video_url
+        meta["faststart"] = True
+
+    poster_name = f"{filename.rsplit('.', 1)[0]}_poster.jpg"
+    extract_video_poster(path, os.path.join(UPLOADS_DIR, poster_name), meta.get("duration"))
+    meta["poster"] = f"/api/uploads/{poster_name}"
+    return meta
+
+def process_listing_videos(listing_id, video_urls):
+    """Post-process every video of a listing and record the results on it"""
+    if not ffmpeg_available():
+        logger.warning("ffmpeg not found, skipping video processing")
         return None
+    video_meta = []
+    for video_url in video_urls:
+        try:
+            video_meta.append(process_video(video_url))
+            logger.info("Video processed", extra=log_fields(url=video_url))
+        except Exception as e:
+            logger.exception("Failed to process video", extra=log_fields(url=video_url))
+            video_meta.append({"url": video_url, "error": str(e)[:200]})
+
+    # Point the listing at the remuxed copies
+    replaced = {meta["original_url"]: meta["url"] for meta in video_meta if meta.get("original_url")}
+    db.listings.update_one(
+        {"listing_id": listing_id},
+        {"$set": {
+            "videos": [replaced.get(video_url, video_url) for video_url in video_urls],
+            "video_meta": video_meta,
+            "videos_processed_at": datetime.utcnow()
+        }}
+    )
+    return video_meta
+
+class ImageVariantCache:
+    """Size-capped on-disk LRU cache of resized image variants"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def _load(self):
+        """Index variants left on disk by previous runs, oldest first"""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+        self.loaded = True
+
+    def path_for(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """Return the cached variant path and mark it as recently used"""
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            if name not in self.entries:
+                return None
+            path = self.path_for(name)
+            try:
+                # mtime doubles as the recency marker across restarts
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted by another worker process
+                self.total_bytes -= self.entries.pop(name)
+                return None
+            self.entries.move_to_end(name)
+            return path
+
+    def add(self, name, size):
+        """Record a freshly written variant and evict the least recently used ones"""
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            self.total_bytes -= self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_name, old_size = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                try:
+                    os.remove(self.path_for(old_name))
+                except FileNotFoundError:
+                    pass
+
+image_variant_cache = ImageVariantCache(IMAGE_VARIANT_CACHE_DIR, IMAGE_VARIANT_CACHE_MAX_MB * 1024 * 1024)
+_variant_renders = {}
+
+def snap_variant_width(width):
+    """Round a requested width up to the nearest supported variant width"""
+    for allowed in IMAGE_VARIANT_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return IMAGE_VARIANT_WIDTHS[-1]
+
+async def get_image_variant(source_path, filename, width, fmt):
+    """Return (path, media_type) of a resized variant, rendering it on a cache miss"""
+    image_format, media_type, extension = IMAGE_VARIANT_FORMATS[fmt]
+    variant_name = f"{filename.rsplit('.', 1)[0]}_w{width}.{extension}"
+
+    cached_path = image_variant_cache.get(variant_name)
+    if cached_path:
+        return cached_path, media_type
+
+    # Concurrent requests for the same variant share a single render
+    render = _variant_renders.get(variant_name)
+    if render is None:
+        loop = asyncio.get_running_loop()
+        render = loop.run_in_executor(
+            get_media_pool(),
+            render_image_variant,
+            source_path,
+            image_variant_cache.path_for(variant_name),
+            width,
+            image_format,
+            IMAGE_VARIANT_QUALITY
+        )
+        _variant_renders[variant_name] = render
+        try:
+            size = await render
+        finally:
+            _variant_renders.pop(variant_name, None)
+        image_variant_cache.add(variant_name, size)
+    else:
+        await render
+    return image_variant_cache.path_for(variant_name), media_type
 
 # Database helper functions
 def check_db_connection():
@@ -189,9 +2020,479 @@ def safe_db_operation(operation_func, *args, **kwargs):
         check_db_connection()
         return operation_func(*args, **kwargs)
     except Exception as e:
-        print(f"Database operation error: {e}")
+        logger.exception("Database operation error")
         raise HTTPException(status_code=500, detail=f"Database operation failed: {str(e)}")
 
+# Database indexes
+def ensure_indexes():
+    """Create the indexes the queries below rely on (idempotent)"""
+    if db is None:
+        return
+    index_specs = [
+        (db.jobs, [("status", ASCENDING), ("priority", DESCENDING), ("run_at", ASCENDING)], {"name": "job_lease"}),
+        (db.jobs, [("job_id", ASCENDING)], {"name": "job_id", "unique": True}),
+        (db.jobs, [("dedupe_key", ASCENDING)], {
+            "name": "job_dedupe",
+            "unique": True,
+            "partialFilterExpression": {"dedupe_key": {"$exists": True}}
+        }),
+        (db.jobs, [("finished_at", ASCENDING)], {
+            "name": "job_retention",
+            "expireAfterSeconds": JOB_RETENTION_DAYS * 24 * 3600
+        }),
+        (db.otp_codes, [("phone_number", ASCENDING)], {"name": "otp_phone", "unique": True}),
+        (db.otp_codes, [("expires_at", ASCENDING)], {"name": "otp_expiry", "expireAfterSeconds": 0}),
+        (db.rate_limits, [("expires_at", ASCENDING)], {"name": "rate_limit_expiry", "expireAfterSeconds": 0}),
+        # Fails (and is reported) until duplicate phone numbers from before this index are merged
+        (db.users, [("phone_number", ASCENDING)], {"name": "user_phone", "unique": True}),
+        (db.users, [("user_id", ASCENDING)], {"name": "user_id", "unique": True}),
+        # Covers seller preview queries: equality on seller_id and status, newest first, preview fields only
+        (db.listings, [("seller_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)] + [
+            (field, ASCENDING) for field in PREVIEW_FIELDS if field not in ("status", "created_at")
+        ], {"name": "listing_seller_active_preview"}),
+        (db.contact_events, [("seller_id", ASCENDING), ("created_at", DESCENDING)], {"name": "contact_seller"}),
+        # At most one unpaid order per listing, user and amount
+        (db.payments, [("listing_id", ASCENDING), ("user_id", ASCENDING), ("amount", ASCENDING)], {
+            "name": "payment_open_order",
+            "unique": True,
+            "partialFilterExpression": {"status": "created"}
+        }),
+        (db.payments, [("razorpay_order_id", ASCENDING)], {"name": "payment_order_id"}),
+        (db.payments, [("status", ASCENDING), ("created_at", ASCENDING)], {"name": "payment_status_created"}),
+        (db.payments, [("listing_id", ASCENDING), ("status", ASCENDING)], {"name": "payment_listing_status"}),
+        (db.listings, [("status", ASCENDING), ("listing_id", ASCENDING)], {"name": "listing_status"}),
+        (db.listings, [("listing_id", ASCENDING)], {"name": "listing_id"}),
+        (db.brokers, [("location_keys", ASCENDING)], {"name": "broker_location_keys"}),
+        (db.brokers, [("broker_id", ASCENDING)], {"name": "broker_id"}),
+        # lead_id breaks created_at ties: every lead of one fan-out shares its timestamp
+        (db.broker_leads, [("broker_id", ASCENDING), ("created_at", DESCENDING), ("lead_id", DESCENDING)], {
+            "name": "lead_inbox_page"
+        }),
+        (db.broker_leads, [("broker_id", ASCENDING), ("listing_id", ASCENDING)], {"name": "lead_unique", "unique": True}),
+        (db.broker_leads, [("broker_id", ASCENDING), ("read", ASCENDING)], {
+            "name": "lead_unread",
+            "partialFilterExpression": {"read": False}
+        }),
+        (db.broker_leads, [("listing_id", ASCENDING)], {"name": "lead_listing"}),
+        (db.broadcasts, [("broadcast_id", ASCENDING)], {"name": "broadcast_id", "unique": True}),
+        # At most one queued, sending or completed broadcast per listing; failed ones release it
+        (db.broadcasts, [("open_listing_id", ASCENDING)], {
+            "name": "broadcast_open_listing",
+            "unique": True,
+            "partialFilterExpression": {"open_listing_id": {"$exists": True}}
+        }),
+        (db.broadcast_deliveries, [("broadcast_id", ASCENDING), ("broker_id", ASCENDING)], {
+            "name": "broadcast_delivery",
+            "unique": True
+        }),
+        (db.payments, [("listing_activation_pending", ASCENDING)], {
+            "name": "payment_activation_outbox",
+            "partialFilterExpression": {"listing_activation_pending": True}
+        }),
+        (db.payments, [("user_id", ASCENDING), ("idempotency_key", ASCENDING)], {
+            "name": "payment_idempotency_key",
+            "unique": True,
+            "partialFilterExpression": {"idempotency_key": {"$exists": True}}
+        }),
+    ]
+    for collection, keys, options in index_specs:
+        try:
+            collection.create_index(keys, **options)
+        except Exception:
+            logger.exception("Failed to create index", extra=log_fields(index=options.get('name'), collection=collection.name))
+    # Indexes replaced by the ones above under a new name
+    obsolete_indexes = [
+        (db.listings, "listing_seller_preview"),
+        (db.broker_leads, "lead_inbox"),
+    ]
+    for collection, name in obsolete_indexes:
+        try:
+            if name in collection.index_information():
+                collection.drop_index(name)
+        except Exception:
+            logger.exception("Failed to drop obsolete index", extra=log_fields(index=name, collection=collection.name))
+
+def backfill_broker_location_keys():
+    """Derive location_keys for brokers registered before they existed"""
+    if db is None:
+        return
+    try:
+        missing = db.brokers.find({"location_keys": {"$exists": False}}, {"_id": 1, "location": 1})
+        updates = [
+            UpdateOne({"_id": broker["_id"]}, {"$set": {"location_keys": location_keys(broker.get("location"))}})
+            for broker in missing
+        ]
+        if updates:
+            db.brokers.bulk_write(updates, ordered=False)
+            logger.info("Backfilled broker location keys", extra=log_fields(brokers=len(updates)))
+    except Exception:
+        logger.exception("Failed to backfill broker location keys")
+
+def cover_photo_of(photos):
+    """First photo URL of a listing; legacy base64 photos are too large to index"""
+    if photos and isinstance(photos[0], str):
+        return photos[0]
+    return None
+
+def backfill_listing_cover_photos():
+    """Set cover_photo on listings created before preview queries existed"""
+    if db is None:
+        return
+    try:
+        missing = db.listings.find({"cover_photo": {"$exists": False}}, {"_id": 1, "photos": {"$slice": 1}})
+        backfilled = 0
+        for batch in iter_batches(missing, 500):
+            updates = [
+                UpdateOne({"_id": listing["_id"]}, {"$set": {"cover_photo": cover_photo_of(listing.get("photos"))}})
+                for listing in batch
+            ]
+            db.listings.bulk_write(updates, ordered=False)
+            backfilled += len(updates)
+        if backfilled:
+            logger.info("Backfilled listing cover photos", extra=log_fields(listings=backfilled))
+    except Exception:
+        logger.exception("Failed to backfill listing cover photos")
+
+@app.on_event("startup")
+def create_indexes_on_startup():
+    ensure_indexes()
+    backfill_broker_location_keys()
+    backfill_listing_cover_photos()
+
+# Background job queue
+# Jobs live in the `jobs` collection. A worker leases a job by atomically flipping it to
+# "running" and pushing run_at to the lease expiry, so a job whose worker died becomes
+# visible again once the lease runs out.
+JOB_HANDLERS = {}
+
+def job_handler(job_type):
+    """Register a function as the handler for a job type"""
+    def register(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return register
+
+def enqueue_job(job_type, payload, priority=0, delay_seconds=0, max_attempts=None, dedupe_key=None):
+    """Queue a job for the background workers and return its job_id
+
+    Jobs with a dedupe_key are only queued if no queued or running job has the same key;
+    None is returned in that case.
+    """
+    check_db_connection()
+    now = datetime.utcnow()
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "type": job_type,
+        "payload": payload,
+        "status": "queued",
+        "priority": priority,
+        "attempts": 0,
+        "max_attempts": max_attempts or JOB_MAX_ATTEMPTS,
+        "run_at": now + timedelta(seconds=delay_seconds),
+        "created_at": now,
+        "updated_at": now
+    }
+    if dedupe_key:
+        job["dedupe_key"] = dedupe_key
+    try:
+        db.jobs.insert_one(job)
+    except DuplicateKeyError:
+        return None
+    return job["job_id"]
+
+RECURRING_JOBS = {}
+
+def recurring_job(job_type, interval_seconds):
+    """Have the workers run a registered job type every interval_seconds"""
+    RECURRING_JOBS[job_type] = interval_seconds
+
+def enqueue_next_recurring_run(job_type):
+    """Queue the run for the next interval boundary; the slot dedupe_key lets every worker try"""
+    interval = RECURRING_JOBS[job_type]
+    slot = int(time.time() // interval) + 1
+    enqueue_job(
+        job_type,
+        {"slot": slot},
+        delay_seconds=max(0, slot * interval - time.time()),
+        dedupe_key=f"{job_type}:{slot}"
+    )
+
+ATTEMPTS_LEFT = {"$lt": ["$attempts", {"$ifNull": ["$max_attempts", JOB_MAX_ATTEMPTS]}]}
+
+def lease_job(worker_id):
+    """Atomically claim the most urgent runnable job, or return None
+
+    Only queued jobs with attempts left are leased; jobs whose worker died are put back in
+    the queue (or failed) by sweep_expired_leases.
+    """
+    now = datetime.utcnow()
+    return db.jobs.find_one_and_update(
+        {"status": "queued", "run_at": {"$lte": now}, "$expr": ATTEMPTS_LEFT},
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": worker_id,
+                "leased_at": now,
+                "run_at": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("priority", DESCENDING), ("run_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def extend_job_lease(job, worker_id):
+    """Push the visibility timeout of a job this worker still holds"""
+    now = datetime.utcnow()
+    result = db.jobs.update_one(
+        {"job_id": job["job_id"], "worker_id": worker_id, "status": "running"},
+        {"$set": {"run_at": now + timedelta(seconds=JOB_LEASE_SECONDS), "updated_at": now}}
+    )
+    return result.matched_count == 1
+
+def complete_job(job, worker_id, result=None):
+    now = datetime.utcnow()
+    db.jobs.update_one(
+        {"job_id": job["job_id"], "worker_id": worker_id},
+        {
+            "$set": {"status": "done", "result": result, "finished_at": now, "updated_at": now},
+            "$unset": {"dedupe_key": ""}
+        }
+    )
+
+def fail_job(job, worker_id, error):
+    """Schedule a retry with exponential backoff, or give up after max_attempts"""
+    now = datetime.utcnow()
+    update = {"last_error": str(error)[:1000], "updated_at": now}
+    if job["attempts"] >= job.get("max_attempts", JOB_MAX_ATTEMPTS):
+        update.update({"status": "failed", "finished_at": now})
+        unset = {"dedupe_key": ""}
+    else:
+        backoff = min(JOB_BACKOFF_BASE_SECONDS * 2 ** (job["attempts"] - 1), JOB_BACKOFF_MAX_SECONDS)
+        # Jitter spreads out retries of jobs that failed together
+        update.update({"status": "queued", "run_at": now + timedelta(seconds=backoff * random.uniform(0.8, 1.2))})
+        unset = {"worker_id": ""}
+    db.jobs.update_one({"job_id": job["job_id"], "worker_id": worker_id}, {"$set": update, "$unset": unset})
+
+def sweep_expired_leases():
+    """Handle running jobs whose lease ran out because their worker crashed or was killed
+
+    Like fail_job: jobs out of attempts are failed, the rest are requeued with backoff. The
+    worker_id is cleared, so a worker that was merely stalled can't complete the job later.
+    """
+    now = datetime.utcnow()
+    expired = {"status": "running", "run_at": {"$lte": now}}
+    error = "Job lease expired; the worker stopped before finishing"
+    failed = db.jobs.update_many(
+        dict(expired, **{"$expr": {"$not": [ATTEMPTS_LEFT]}}),
+        {
+            "$set": {"status": "failed", "last_error": error, "finished_at": now, "updated_at": now},
+            "$unset": {"dedupe_key": "", "worker_id": ""}
+        }
+    )
+    backoff_ms = {"$min": [
+        {"$multiply": [JOB_BACKOFF_BASE_SECONDS * 1000, {"$pow": [2, {"$max": [0, {"$subtract": ["$attempts", 1]}]}]}]},
+        JOB_BACKOFF_MAX_SECONDS * 1000
+    ]}
+    requeued = db.jobs.update_many(
+        dict(expired, **{"$expr": ATTEMPTS_LEFT}),
+        [
+            {"$set": {"status": "queued", "last_error": error, "run_at": {"$add": [now, backoff_ms]}, "updated_at": now}},
+            {"$unset": "worker_id"}
+        ]
+    )
+    if failed.modified_count or requeued.modified_count:
+        logger.warning(
+            "Recovered jobs with expired leases",
+            extra=log_fields(failed=failed.modified_count, requeued=requeued.modified_count)
+        )
+
+def run_job(job, worker_id):
+    """Execute a leased job, keeping its lease alive while the handler runs"""
+    handler = JOB_HANDLERS.get(job["type"])
+    if handler is None:
+        fail_job(job, worker_id, f"No handler registered for job type {job['type']}")
+        return
+
+    finished = threading.Event()
+
+    def keep_lease():
+        while not finished.wait(JOB_LEASE_SECONDS / 3):
+            extend_job_lease(job, worker_id)
+
+    heartbeat = threading.Thread(target=keep_lease, daemon=True)
+    heartbeat.start()
+    # Logs written while the job runs are correlated by job_id instead of a request ID
+    request_id_token = request_id_var.set(f"job:{job['job_id']}")
+    scope_token = request_scope_var.set({"job": f"job:{job['type']}"})
+    try:
+        result = handler(job["payload"])
+        complete_job(job, worker_id, result)
+    except Exception as e:
+        logger.exception("Job failed", extra=log_fields(job_type=job['type'], job_id=job['job_id'], attempt=job['attempts']))
+        fail_job(job, worker_id, e)
+    finally:
+        request_id_var.reset(request_id_token)
+        request_scope_var.reset(scope_token)
+        finished.set()
+        if job["type"] in RECURRING_JOBS:
+            try:
+                enqueue_next_recurring_run(job["type"])
+            except Exception:
+                logger.exception("Failed to schedule next recurring run", extra=log_fields(job_type=job['type']))
+
+def job_worker_loop(worker_id, stop_event):
+    next_sweep = 0
+    while not stop_event.is_set():
+        if time.monotonic() >= next_sweep:
+            next_sweep = time.monotonic() + JOB_LEASE_SECONDS / 3
+            try:
+                sweep_expired_leases()
+            except Exception:
+                logger.exception("Failed to sweep expired job leases")
+        try:
+            job = lease_job(worker_id)
+        except Exception:
+            logger.exception("Failed to lease job")
+            job = None
+        if job is None:
+            stop_event.wait(JOB_POLL_INTERVAL_SECONDS)
+            continue
+        run_job(job, worker_id)
+
+def start_job_workers(concurrency=JOB_WORKER_CONCURRENCY, stop_event=None):
+    """Start worker threads that process the job queue until stop_event is set"""
+    stop_event = stop_event or threading.Event()
+    for job_type in RECURRING_JOBS:
+        try:
+            enqueue_next_recurring_run(job_type)
+        except Exception:
+            logger.exception("Failed to schedule recurring job", extra=log_fields(job_type=job_type))
+    threads = []
+    for index in range(concurrency):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+        thread = threading.Thread(target=job_worker_loop, args=(worker_id, stop_event), daemon=True, name=f"job-worker-{index}")
+        thread.start()
+        threads.append(thread)
+    return stop_event, threads
+
+_job_worker_stop = None
+
+@app.on_event("startup")
+def start_in_process_job_workers():
+    global _job_worker_stop
+    if JOB_WORKER_IN_PROCESS and db is not None:
+        _job_worker_stop, _ = start_job_workers()
+        logger.info("Started in-process job workers", extra=log_fields(concurrency=JOB_WORKER_CONCURRENCY))
+
+@app.on_event("shutdown")
+def stop_in_process_job_workers():
+    if _job_worker_stop is not None:
+        _job_worker_stop.set()
+
+def run_job_worker():
+    """Entry point for `python server.py worker`, run next to uvicorn"""
+    if db is None:
+        logger.error("Cannot start job worker without a database connection")
+        sys.exit(1)
+    ensure_indexes()
+    stop_event, threads = start_job_workers()
+    logger.info("Job worker running", extra=log_fields(concurrency=JOB_WORKER_CONCURRENCY, job_types=sorted(JOB_HANDLERS)))
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_event.set()
+
+# Job handlers
+@job_handler("video.process")
+def handle_video_process(payload):
+    return process_listing_videos(payload["listing_id"], payload["video_urls"])
+
+# Local OTP engine
+def hash_otp(phone_number, code):
+    """Keyed hash of a code; the phone number salts it so equal codes never share a hash"""
+    message = f"{phone_number}:{code}".encode()
+    return hmac.new(OTP_HASH_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+def issue_local_otp(phone_number):
+    """Generate a fresh code for a phone number, replacing any outstanding one"""
+    code = f"{secrets.randbelow(10 ** OTP_LENGTH):0{OTP_LENGTH}d}"
+    now = datetime.utcnow()
+    db.otp_codes.update_one(
+        {"phone_number": phone_number},
+        {"$set": {
+            "code_hash": hash_otp(phone_number, code),
+            "attempts": 0,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=OTP_TTL_SECONDS)
+        }},
+        upsert=True
+    )
+    return code
+
+def check_local_otp(phone_number, code):
+    """Consume a matching, unexpired code in one indexed round trip
+
+    A wrong code costs a second write to count the attempt; after OTP_MAX_ATTEMPTS wrong
+    codes the outstanding code can no longer be used.
+    """
+    matched = db.otp_codes.find_one_and_delete({
+        "phone_number": phone_number,
+        "code_hash": hash_otp(phone_number, code),
+        "expires_at": {"$gt": datetime.utcnow()},
+        "attempts": {"$lt": OTP_MAX_ATTEMPTS}
+    }, projection={"_id": 1})
+    if matched:
+        return True
+    db.otp_codes.update_one({"phone_number": phone_number}, {"$inc": {"attempts": 1}})
+    return False
+
+async def deliver_otp_sms(phone_number, code):
+    """Send a locally generated code through the configured SMS backend"""
+    body = f"Your OnlyLands verification code is {code}. It expires in {OTP_TTL_SECONDS // 60} minutes."
+    if OTP_SMS_BACKEND == "null":
+        return
+    if OTP_SMS_BACKEND == "console":
+        logger.info("SMS stand-in", extra=log_fields(phone_number=phone_number, body=body))
+        return
+    if not twilio_client or not (TWILIO_SMS_FROM or TWILIO_MESSAGING_SERVICE_SID):
+        raise RuntimeError("Twilio SMS sender is not configured")
+    sender = {"messaging_service_sid": TWILIO_MESSAGING_SERVICE_SID} if TWILIO_MESSAGING_SERVICE_SID else {"from_": TWILIO_SMS_FROM}
+    await call_twilio(twilio_client.messages.create, to=phone_number, body=body, **sender)
+
+def login_verified_user(phone_number, user_type):
+    """Find or create the user behind a verified phone number and issue their JWT
+
+    One upsert against the unique phone_number index both creates new users and switches
+    the user_type of existing ones, so concurrent logins cannot create duplicates.
+    """
+    now = datetime.utcnow()
+    query = {"phone_number": phone_number}
+    update = {
+        "$set": {"user_type": user_type, "last_login_at": now},
+        "$setOnInsert": {"user_id": str(uuid.uuid4()), "created_at": now}
+    }
+    try:
+        user = db.users.find_one_and_update(
+            query, update, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # A concurrent login inserted this phone first; the retry updates that user instead
+        user = db.users.find_one_and_update(
+            query, update, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    
+    # Generate JWT token with the current user_type
+    token = jwt.encode({
+        "user_id": user["user_id"],
+        "phone_number": phone_number,
+        "user_type": user_type,
+        "exp": datetime.utcnow() + timedelta(hours=24)
+    }, JWT_SECRET, algorithm="HS256")
+    return user, token
+
 # JWT token verification
 def verify_jwt_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Verify JWT token for regular users"""
@@ -219,11 +2520,30 @@ def verify_admin_token(credentials: HTTPAuthorizationCredentials = Depends(secur
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def verify_any_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Verify a user or admin JWT and return its payload"""
+    try:
+        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
+        if payload.get("user_type") != "admin" and not payload.get("user_id"):
+            raise HTTPException(status_code=401, detail="Invalid token")
+        return payload
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
 # Routes
 @app.get("/api/")
 async def root():
     return {"message": "OnlyLands API is running"}
 
+@app.get("/metrics")
+async def metrics_endpoint(authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint; requires a bearer token when METRICS_TOKEN is set"""
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint for deployment verification"""
@@ -243,6 +2563,9 @@ async def health_check():
                 "twilio": "configured" if twilio_client else "not_configured",
                 "razorpay": "configured" if razorpay_client else "not_configured",
                 "s3": "configured" if s3_client else "not_configured"
+            },
+            "circuit_breakers": {
+                "twilio": twilio_breaker.snapshot()
             }
         }
     except Exception as e:
@@ -253,7 +2576,7 @@ async def health_check():
         }
 
 @app.post("/api/send-otp")
-async def send_otp(request: dict):
+async def send_otp(request: dict, http_request: Request):
     """Send OTP to phone number using Twilio with demo fallback"""
     try:
         phone_number = request.get("phone_number")
@@ -262,6 +2585,27 @@ async def send_otp(request: dict):
         if not phone_number:
             raise HTTPException(status_code=400, detail="Phone number is required")
         
+        enforce_otp_rate_limits(phone_number, get_client_ip(http_request))
+        
+        if OTP_ENGINE == "local":
+            check_db_connection()
+            code = issue_local_otp(phone_number)
+            try:
+                await deliver_otp_sms(phone_number, code)
+            except Exception as sms_error:
+                logger.warning("SMS delivery error, falling back to demo mode", extra=log_fields(error=str(sms_error)))
+                return {
+                    "message": "OTP sent successfully (Demo Mode)", 
+                    "status": "demo_mode",
+                    "phone_number": phone_number,
+                    "demo_info": "Service temporarily unavailable. Use OTP 123456 for testing."
+                }
+            return {
+                "message": "OTP sent successfully", 
+                "status": "pending",
+                "phone_number": phone_number
+            }
+        
         if not twilio_client or not TWILIO_VERIFY_SERVICE_SID:
             # No Twilio configured, use demo mode
             return {
@@ -271,16 +2615,17 @@ async def send_otp(request: dict):
                 "demo_info": "Service temporarily unavailable. Use OTP 123456 for testing."
             }
         
-        print(f"Attempting to send OTP to {phone_number}")
+        logger.info("Attempting to send OTP", extra=log_fields(LOG_SAMPLE_RATE, phone_number=phone_number))
         
         try:
             # Try to send OTP using Twilio Verify
-            verification = twilio_client.verify.v2.services(TWILIO_VERIFY_SERVICE_SID).verifications.create(
+            verification = await call_twilio(
+                twilio_client.verify.v2.services(TWILIO_VERIFY_SERVICE_SID).verifications.create,
                 to=phone_number,
                 channel='sms'
             )
             
-            print(f"Twilio response: {verification.status}")
+            logger.info("Twilio verification sent", extra=log_fields(LOG_SAMPLE_RATE, status=verification.status))
             
             return {
                 "message": "OTP sent successfully", 
@@ -288,14 +2633,22 @@ async def send_otp(request: dict):
                 "phone_number": phone_number
             }
             
+        except CircuitOpenError:
+            # Twilio is failing repeatedly - skip the call and serve demo mode immediately
+            return {
+                "message": "OTP sent successfully (Demo Mode)", 
+                "status": "demo_mode",
+                "phone_number": phone_number,
+                "demo_info": "Service temporarily unavailable. Use OTP 123456 for testing."
+            }
         except Exception as twilio_error:
             error_message = str(twilio_error)
-            print(f"Twilio error details: {error_message}")
+            logger.warning("Twilio error sending OTP", extra=log_fields(error=error_message))
             
             # Handle specific Twilio errors with demo fallback
             if "20429" in error_message:
                 # Rate limit exceeded - fall back to demo mode
-                print("Twilio rate limit exceeded, falling back to demo mode")
+                logger.warning("Twilio rate limit exceeded, falling back to demo mode")
                 return {
                     "message": "OTP sent successfully (Demo Mode)", 
                     "status": "demo_mode",
@@ -320,7 +2673,7 @@ async def send_otp(request: dict):
                 }
             else:
                 # Other Twilio errors - fall back to demo mode
-                print(f"Twilio error, falling back to demo mode: {twilio_error}")
+                logger.warning("Twilio error, falling back to demo mode", extra=log_fields(error=str(twilio_error)))
                 return {
                     "message": "OTP sent successfully (Demo Mode)", 
                     "status": "demo_mode",
@@ -331,8 +2684,8 @@ async def send_otp(request: dict):
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
-    except Exception as e:
-        print(f"Error sending OTP: {e}")
+    except Exception:
+        logger.exception("Error sending OTP")
         # Final fallback to demo mode
         return {
             "message": "OTP sent successfully (Demo Mode)", 
@@ -354,47 +2707,24 @@ async def verify_otp(request: dict):
         
         # Check for demo OTP first
         if otp == "123456":
-            print(f"Using demo OTP for {phone_number}")
+            logger.info("Using demo OTP", extra=log_fields(LOG_SAMPLE_RATE, phone_number=phone_number))
             # Demo OTP verification - always succeeds
             try:
                 check_db_connection()
-                user = db.users.find_one({"phone_number": phone_number})
-                if not user:
-                    # Create new user
-                    user_id = str(uuid.uuid4())
-                    user = {
-                        "user_id": user_id,
-                        "phone_number": phone_number,
-                        "user_type": user_type,
-                        "created_at": datetime.utcnow()
-                    }
-                    db.users.insert_one(user)
-                else:
-                    # Update existing user's user_type if it's different
-                    if user.get("user_type") != user_type:
-                        db.users.update_one(
-                            {"phone_number": phone_number},
-                            {"$set": {"user_type": user_type, "updated_at": datetime.utcnow()}}
-                        )
-                        user["user_type"] = user_type
-            except Exception as e:
-                print(f"Database error during demo OTP verification: {e}")
+                user, token = login_verified_user(phone_number, user_type)
+            except Exception:
+                logger.exception("Database error during demo OTP verification")
                 raise HTTPException(status_code=500, detail="Database connection error")
             
-            # Remove MongoDB ObjectId for JSON serialization
-            if '_id' in user:
-                del user['_id']
-            
-            # Generate JWT token with the current user_type
-            token = jwt.encode({
-                "user_id": user["user_id"],
-                "phone_number": phone_number,
-                "user_type": user_type,
-                "exp": datetime.utcnow() + timedelta(hours=24)
-            }, JWT_SECRET, algorithm="HS256")
-            
             return {"message": "OTP verified successfully (Demo Mode)", "token": token, "user": user}
         
+        if OTP_ENGINE == "local":
+            check_db_connection()
+            if not check_local_otp(phone_number, otp):
+                raise HTTPException(status_code=400, detail="Invalid OTP or OTP has expired")
+            user, token = login_verified_user(phone_number, user_type)
+            return {"message": "OTP verified successfully", "token": token, "user": user}
+        
         # Try genuine Twilio verification
         if not twilio_client or not TWILIO_VERIFY_SERVICE_SID:
             # If no Twilio configured and not demo OTP, reject
@@ -402,52 +2732,23 @@ async def verify_otp(request: dict):
         
         try:
             # Verify OTP using Twilio Verify
-            verification_check = twilio_client.verify.v2.services(TWILIO_VERIFY_SERVICE_SID).verification_checks.create(
+            verification_check = await call_twilio(
+                twilio_client.verify.v2.services(TWILIO_VERIFY_SERVICE_SID).verification_checks.create,
                 to=phone_number,
-                code=otp
-            )
-            
-            if verification_check.status == 'approved':
-                # Check if user exists
-                user = db.users.find_one({"phone_number": phone_number})
-                if not user:
-                    # Create new user
-                    user_id = str(uuid.uuid4())
-                    user = {
-                        "user_id": user_id,
-                        "phone_number": phone_number,
-                        "user_type": user_type,
-                        "created_at": datetime.utcnow()
-                    }
-                    db.users.insert_one(user)
-                else:
-                    # Update existing user's user_type if it's different
-                    if user.get("user_type") != user_type:
-                        db.users.update_one(
-                            {"phone_number": phone_number},
-                            {"$set": {"user_type": user_type, "updated_at": datetime.utcnow()}}
-                        )
-                        user["user_type"] = user_type
-                
-                # Remove MongoDB ObjectId for JSON serialization
-                if '_id' in user:
-                    del user['_id']
-                
-                # Generate JWT token with the current user_type
-                token = jwt.encode({
-                    "user_id": user["user_id"],
-                    "phone_number": phone_number,
-                    "user_type": user_type,
-                    "exp": datetime.utcnow() + timedelta(hours=24)
-                }, JWT_SECRET, algorithm="HS256")
-                
+                code=otp
+            )
+            
+            if verification_check.status == 'approved':
+                user, token = login_verified_user(phone_number, user_type)
                 return {"message": "OTP verified successfully", "token": token, "user": user}
             else:
                 raise HTTPException(status_code=400, detail="Invalid OTP")
                 
+        except CircuitOpenError:
+            raise HTTPException(status_code=400, detail="OTP service temporarily unavailable. Please use OTP 123456 for demo.")
         except Exception as twilio_error:
             error_message = str(twilio_error)
-            print(f"Twilio verification error: {error_message}")
+            logger.warning("Twilio verification error", extra=log_fields(error=error_message))
             
             # Handle specific Twilio verification errors
             if "20404" in error_message:
@@ -460,8 +2761,8 @@ async def verify_otp(request: dict):
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
-    except Exception as e:
-        print(f"Error verifying OTP: {e}")
+    except Exception:
+        logger.exception("Error verifying OTP")
         raise HTTPException(status_code=500, detail="Failed to verify OTP")
 
 @app.post("/api/post-land")
@@ -480,18 +2781,21 @@ async def post_land(
 ):
     """Post a new land listing"""
     try:
-        # Upload photos to S3
+        # Normalize and store photos concurrently in the media pool
         photo_urls = []
-        for photo in photos:
-            if photo.filename:
-                content = await photo.read()
-                filename = f"photos/{uuid.uuid4()}.{photo.filename.split('.')[-1]}"
-                photo_url = upload_to_s3(content, filename, photo.content_type)
-                if photo_url:  # photo_url is now a string URL
-                    photo_urls.append(photo_url)
-                    print(f"✅ Photo uploaded: {photo.filename}")
-                else:
-                    print(f"❌ Failed to upload photo: {photo.filename}")
+        photo_placeholders = []
+        photo_archive = []
+        named_photos = [photo for photo in photos if photo.filename]
+        results = await asyncio.gather(*(ingest_photo(photo) for photo in named_photos))
+        for photo, (photo_url, placeholder, archived) in zip(named_photos, results):
+            if photo_url:  # photo_url is now a string URL
+                photo_urls.append(photo_url)
+                photo_placeholders.append(placeholder)
+                if archived:
+                    photo_archive.append(archived)
+                logger.debug("Photo uploaded", extra=log_fields(filename=photo.filename))
+            else:
+                logger.warning("Failed to upload photo", extra=log_fields(filename=photo.filename))
         
         # Upload videos to S3
         video_urls = []
@@ -502,9 +2806,9 @@ async def post_land(
                 video_url = upload_to_s3(content, filename, video.content_type)
                 if video_url:  # video_url is now a string URL
                     video_urls.append(video_url)
-                    print(f"✅ Video uploaded: {video.filename}")
+                    logger.debug("Video uploaded", extra=log_fields(filename=video.filename))
                 else:
-                    print(f"❌ Failed to upload video: {video.filename}")
+                    logger.warning("Failed to upload video", extra=log_fields(filename=video.filename))
         
         # Create listing
         listing_id = str(uuid.uuid4())
@@ -520,73 +2824,260 @@ async def post_land(
             "latitude": latitude,
             "longitude": longitude,
             "photos": photo_urls,
+            "cover_photo": cover_photo_of(photo_urls),
+            # Tiny data URI previews, aligned with photos (None where decoding failed)
+            "photo_placeholders": photo_placeholders,
             "videos": video_urls,
             "status": "pending_payment",
             "created_at": datetime.utcnow()
         }
+        if photo_archive:
+            listing["photo_archive"] = photo_archive
         
         db.listings.insert_one(listing)
+
+        # Remux and poster extraction run on the job queue; the upload never waits on ffmpeg
+        if video_urls:
+            enqueue_job("video.process", {"listing_id": listing_id, "video_urls": video_urls})
         
         return {"message": "Land listing created successfully", "listing_id": listing_id}
-    except Exception as e:
-        print(f"Error posting land: {e}")
+    except Exception:
+        logger.exception("Error posting land")
         raise HTTPException(status_code=500, detail="Failed to post land listing")
 
 @app.get("/api/my-listings")
 async def get_my_listings(user_id: str = Depends(verify_jwt_token)):
     """Get listings for the authenticated user"""
     try:
-        listings = list(db.listings.find({"seller_id": user_id}))
-        for listing in listings:
-            listing['_id'] = str(listing['_id'])
-        return {"listings": listings}
-    except Exception as e:
-        print(f"Error getting listings: {e}")
+        listings = list(db.listings.find({"seller_id": user_id}, {"_id": 0}))
+        return MongoJSONResponse({"listings": listings})
+    except Exception:
+        logger.exception("Error getting listings")
         raise HTTPException(status_code=500, detail="Failed to get listings")
 
+def preview_image(photo_url):
+    """Describe a cover photo the way listing consumers expect image metadata"""
+    if photo_url.startswith("https://"):
+        return {"storage_type": "s3", "s3_url": photo_url}
+    return {"storage_type": "local", "url": photo_url}
+
+def seller_listing_previews(seller_ids, limit):
+    """Newest active listings per seller, answered from the listing_seller_active_preview index alone
+
+    One bounded query per seller: each reads at most `limit` index entries, however many
+    listings the seller has. Unpaid, sold and deactivated listings are never previewed.
+    """
+    projection = {field: 1 for field in PREVIEW_FIELDS}
+    projection.update({"seller_id": 1, "_id": 0})
+    sellers = {}
+    for seller_id in seller_ids:
+        cursor = db.listings.find({"seller_id": seller_id, "status": "active"}, projection).sort(
+            "created_at", DESCENDING
+        ).limit(limit)
+        previews = []
+        for preview in cursor:
+            cover_photo = preview.pop("cover_photo", None)
+            preview["images"] = [preview_image(cover_photo)] if cover_photo else []
+            previews.append(preview)
+        sellers[seller_id] = previews
+    return sellers
+
+@app.get("/api/listings/preview/{seller_ids}")
+@db_budget(PREVIEW_MAX_SELLERS, repeats=PREVIEW_MAX_SELLERS + 1)
+async def get_listing_previews(seller_ids: str, limit: int = PREVIEW_DEFAULT_LIMIT):
+    """Newest active listings per seller with preview fields only; comma-separate IDs to batch sellers"""
+    try:
+        ids = list(dict.fromkeys(seller_id.strip() for seller_id in seller_ids.split(",") if seller_id.strip()))
+        if not ids:
+            raise HTTPException(status_code=400, detail="At least one seller_id is required")
+        if len(ids) > PREVIEW_MAX_SELLERS:
+            raise HTTPException(status_code=400, detail=f"At most {PREVIEW_MAX_SELLERS} sellers per request")
+        limit = max(1, min(limit, PREVIEW_MAX_LIMIT))
+        
+        check_db_connection()
+        sellers = seller_listing_previews(ids, limit)
+        listings = [preview for previews in sellers.values() for preview in previews]
+        return {"listings": listings, "sellers": sellers}
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error getting listing previews")
+        raise HTTPException(status_code=500, detail="Failed to get listing previews")
+
+class CatalogueCache:
+    """Serialized active-listing catalogue plus its compressed encodings
+
+    Each version of the catalogue is serialized once and compressed at most once per
+    encoding; requests only pick the stored bytes that match their Accept-Encoding.
+    `lock` only guards swapping entries, so invalidation never waits on a rebuild; rebuilds
+    are serialized by `rebuild_lock`, and one that an invalidation overtook is not stored.
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl = ttl_seconds
+        self.entry = None
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.entry = None
+            self.generation += 1
+
+    def current(self):
+        with self.lock:
+            entry = self.entry
+            if entry is not None and entry["expires_at"] >= time.monotonic():
+                return entry, self.generation
+            return None, self.generation
+
+    def rebuild(self):
+        """Query and serialize the catalogue, or return the entry a concurrent rebuild just stored"""
+        with self.rebuild_lock:
+            entry, generation = self.current()
+            if entry is not None:
+                return entry
+            listings = list(db.listings.find({"status": "active"}, {"_id": 0}))
+            entry = {
+                "identity": MongoJSONResponse({"listings": listings}).body,
+                "expires_at": time.monotonic() + self.ttl,
+            }
+            with self.lock:
+                if self.generation == generation:
+                    self.entry = entry
+            return entry
+
+    def body(self, encoding=None):
+        """Return (body, content_encoding) for the current catalogue, rebuilding it when stale"""
+        entry, _ = self.current()
+        if entry is None:
+            entry = self.rebuild()
+        if encoding is None or len(entry["identity"]) < COMPRESSION_MIN_SIZE:
+            return entry["identity"], None
+        compressed = entry.get(encoding)
+        if compressed is None:
+            compressed = compress_body(entry["identity"], encoding)
+            with self.lock:
+                compressed = entry.setdefault(encoding, compressed)
+        return compressed, encoding
+
+catalogue_cache = CatalogueCache(CATALOGUE_CACHE_TTL_SECONDS)
+
+async def catalogue_response(request):
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    body, content_encoding = await asyncio.to_thread(catalogue_cache.body, encoding)
+    headers = {"Vary": "Accept-Encoding"}
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.get("/api/listings")
-async def get_listings():
+@db_budget(1)
+async def get_listings(request: Request):
     """Get all active listings"""
     try:
-        listings = list(db.listings.find({"status": "active"}))
-        for listing in listings:
-            listing['_id'] = str(listing['_id'])
-        return {"listings": listings}
-    except Exception as e:
-        print(f"Error getting listings: {e}")
+        return await catalogue_response(request)
+    except Exception:
+        logger.exception("Error getting listings")
         raise HTTPException(status_code=500, detail="Failed to get listings")
 
 @app.get("/api/uploads/{filename}")
-async def serve_uploaded_file(filename: str):
-    """Serve uploaded files from local storage"""
+async def serve_uploaded_file(filename: str, w: Optional[int] = None, fmt: Optional[str] = None):
+    """Serve uploaded files from local storage, optionally as a resized image variant"""
     try:
-        file_path = f"/app/uploads/{filename}"
-        if os.path.exists(file_path):
-            return FileResponse(file_path)
-        else:
+        # Uploads are stored flat; reject traversal and the hidden variant directory
+        if os.path.basename(filename) != filename or filename.startswith('.'):
+            raise HTTPException(status_code=404, detail="File not found")
+
+        file_path = os.path.join(UPLOADS_DIR, filename)
+        if not os.path.isfile(file_path):
             raise HTTPException(status_code=404, detail="File not found")
+
+        cache_headers = {"Cache-Control": MEDIA_CACHE_CONTROL}
+        extension = filename.rsplit('.', 1)[-1].lower()
+        if (w is None and fmt is None) or extension not in RESIZABLE_IMAGE_EXTENSIONS:
+            return FileResponse(file_path, headers=cache_headers)
+
+        if w is not None and w <= 0:
+            raise HTTPException(status_code=400, detail="Width must be a positive integer")
+        fmt = (fmt or "jpeg").lower()
+        if fmt not in IMAGE_VARIANT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+        width = snap_variant_width(w or IMAGE_VARIANT_WIDTHS[-1])
+
+        try:
+            variant_path, media_type = await get_image_variant(file_path, filename, width, fmt)
+        except Exception as e:
+            # Undecodable or exotic images still load, just without resizing
+            logger.warning("Failed to render image variant", extra=log_fields(filename=filename, error=str(e)))
+            return FileResponse(file_path, headers=cache_headers)
+
+        return FileResponse(variant_path, media_type=media_type, headers=cache_headers)
     except HTTPException:
         # Re-raise HTTP exceptions (like 404)
         raise
-    except Exception as e:
-        print(f"Error serving file: {e}")
+    except Exception:
+        logger.exception("Error serving file")
         raise HTTPException(status_code=500, detail="Failed to serve file")
 
 @app.get("/api/debug/all-listings")
 async def get_all_listings_debug():
     """Debug endpoint to see all listings regardless of status"""
     try:
-        listings = list(db.listings.find({}))
-        for listing in listings:
-            listing['_id'] = str(listing['_id'])
-        return {"listings": listings, "count": len(listings)}
-    except Exception as e:
-        print(f"Error getting debug listings: {e}")
+        listings = list(db.listings.find({}, {"_id": 0}))
+        return MongoJSONResponse({"listings": listings, "count": len(listings)})
+    except Exception:
+        logger.exception("Error getting debug listings")
         raise HTTPException(status_code=500, detail="Failed to get debug listings")
 
+def build_demo_order(listing_id, user_id, amount_in_paise):
+    """Mock Razorpay order used when no real keys are configured or Razorpay fails"""
+    return {
+        # Random suffix: timestamp-based IDs collided for orders created in the same second
+        "id": f"order_demo_{uuid.uuid4().hex[:14]}",
+        "amount": amount_in_paise,
+        "currency": "INR",
+        "status": "created",
+        "receipt": f"receipt_{listing_id}_{int(time.time())}",
+        "notes": {
+            "listing_id": listing_id,
+            "user_id": user_id,
+            "demo_mode": True
+        }
+    }
+
+def payment_order_response(payment):
+    """Rebuild the create-payment-order response from a stored payment record"""
+    order = payment.get("order") or {
+        "id": payment["razorpay_order_id"],
+        "amount": payment["amount"],
+        "currency": payment.get("currency", "INR"),
+        "status": "created"
+    }
+    return {"order": order, "demo_mode": payment.get("demo_mode", False)}
+
+def reuse_payment_order(payment, listing_id, amount_in_paise):
+    """Replay a stored order for a retry, refusing an Idempotency-Key reused for something else"""
+    if payment["listing_id"] != listing_id or payment["amount"] != amount_in_paise:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different order")
+    if payment.get("status") != "created":
+        raise HTTPException(status_code=409, detail="Payment for this order is already completed")
+    return payment_order_response(payment)
+
 @app.post("/api/create-payment-order")
-async def create_payment_order(request: dict, user_id: str = Depends(verify_jwt_token)):
-    """Create Razorpay payment order with demo mode support"""
+async def create_payment_order(
+    request: dict,
+    user_id: str = Depends(verify_jwt_token),
+    idempotency_key: Optional[str] = Header(default=None)
+):
+    """Create Razorpay payment order with demo mode support
+
+    Retries are idempotent: a repeated Idempotency-Key header, or any still unpaid order
+    for the same listing, user and amount, returns the existing order instead of a new one.
+    A key reused with a different listing or amount gets 422, and one whose order is
+    already paid gets 409.
+    """
     try:
         amount = request.get("amount", 299)  # Default ₹299
         listing_id = request.get("listing_id")
@@ -597,104 +3088,80 @@ async def create_payment_order(request: dict, user_id: str = Depends(verify_jwt_
         # Convert rupees to paise (₹299 = 29900 paise)
         amount_in_paise = amount * 100
         
+        check_db_connection()
+        key_query = {"user_id": user_id, "idempotency_key": idempotency_key}
+        open_order_query = {"listing_id": listing_id, "user_id": user_id, "amount": amount_in_paise, "status": "created"}
+        
+        def find_existing_order():
+            # The key decides first, so a reused key never falls through to another order
+            if idempotency_key:
+                payment = db.payments.find_one(key_query)
+                if payment:
+                    return payment
+            return db.payments.find_one(open_order_query)
+        
+        existing_payment = find_existing_order()
+        if existing_payment:
+            response = reuse_payment_order(existing_payment, listing_id, amount_in_paise)
+            logger.info("Reusing payment order", extra=log_fields(LOG_SAMPLE_RATE, order_id=existing_payment['razorpay_order_id']))
+            return response
+        
         # Check if we have real Razorpay keys or using demo
         if not razorpay_client or RAZORPAY_KEY_ID == "rzp_test_demo123":
-            print("Using demo payment mode - generating mock order")
-            # Create demo order response
-            order_id = f"order_demo_{int(time.time())}"
-            order_data = {
-                "id": order_id,
-                "amount": amount_in_paise,
-                "currency": "INR", 
-                "status": "created",
-                "receipt": f"receipt_{listing_id}_{int(time.time())}",
-                "notes": {
-                    "listing_id": listing_id,
-                    "user_id": user_id,
-                    "demo_mode": True
-                }
-            }
-            
-            # Store payment record in database
-            payment_record = {
-                "razorpay_order_id": order_id,
-                "listing_id": listing_id,
-                "user_id": user_id,
-                "amount": amount_in_paise,
-                "currency": "INR",
-                "status": "created",
-                "demo_mode": True,
-                "created_at": datetime.utcnow()
-            }
-            db.payments.insert_one(payment_record)
-            
-            print(f"Demo payment order created: {order_id}")
-            return {"order": order_data, "demo_mode": True}
+            logger.info("Using demo payment mode - generating mock order", extra=log_fields(LOG_SAMPLE_RATE))
+            order = build_demo_order(listing_id, user_id, amount_in_paise)
+            demo_mode = True
+        else:
+            try:
+                # Try real Razorpay integration off the event loop
+                with track_provider_call("razorpay", "order.create"):
+                    order = await asyncio.to_thread(razorpay_client.order.create, {
+                        "amount": amount_in_paise,
+                        "currency": "INR",
+                        "receipt": f"receipt_{listing_id}_{int(time.time())}",
+                        "notes": {
+                            "listing_id": listing_id,
+                            "user_id": user_id
+                        }
+                    })
+                demo_mode = False
+            except Exception as razorpay_error:
+                logger.warning("Razorpay order creation failed, using demo mode", extra=log_fields(error=str(razorpay_error)))
+                # Fall back to demo mode
+                order = build_demo_order(listing_id, user_id, amount_in_paise)
+                demo_mode = True
+        
+        # Store payment record in database
+        payment_record = {
+            "razorpay_order_id": order["id"],
+            "listing_id": listing_id,
+            "user_id": user_id,
+            "amount": amount_in_paise,
+            "currency": "INR",
+            "status": "created",
+            "demo_mode": demo_mode,
+            "order": order,
+            "created_at": datetime.utcnow()
+        }
+        if idempotency_key:
+            payment_record["idempotency_key"] = idempotency_key
         
         try:
-            # Try real Razorpay integration
-            order = razorpay_client.order.create({
-                "amount": amount_in_paise,
-                "currency": "INR",
-                "receipt": f"receipt_{listing_id}_{int(time.time())}",
-                "notes": {
-                    "listing_id": listing_id,
-                    "user_id": user_id
-                }
-            })
-            
-            # Store payment record in database
-            payment_record = {
-                "razorpay_order_id": order["id"],
-                "listing_id": listing_id,
-                "user_id": user_id,
-                "amount": amount_in_paise,
-                "currency": "INR",
-                "status": "created",
-                "demo_mode": False,
-                "created_at": datetime.utcnow()
-            }
-            db.payments.insert_one(payment_record)
-            
-            return {"order": order, "demo_mode": False}
-            
-        except Exception as razorpay_error:
-            print(f"Razorpay error: {razorpay_error}")
-            # Fall back to demo mode
-            order_id = f"order_demo_{int(time.time())}"
-            order_data = {
-                "id": order_id,
-                "amount": amount_in_paise,
-                "currency": "INR",
-                "status": "created", 
-                "receipt": f"receipt_{listing_id}_{int(time.time())}",
-                "notes": {
-                    "listing_id": listing_id,
-                    "user_id": user_id,
-                    "demo_mode": True
-                }
-            }
-            
-            # Store payment record in database
-            payment_record = {
-                "razorpay_order_id": order_id,
-                "listing_id": listing_id,
-                "user_id": user_id,
-                "amount": amount_in_paise,
-                "currency": "INR",
-                "status": "created",
-                "demo_mode": True,
-                "created_at": datetime.utcnow()
-            }
             db.payments.insert_one(payment_record)
-            
-            print(f"Fallback: Demo payment order created: {order_id}")
-            return {"order": order_data, "demo_mode": True}
+        except DuplicateKeyError:
+            # A concurrent request for the same order won the race; hand out its order
+            existing_payment = find_existing_order()
+            if existing_payment:
+                return reuse_payment_order(existing_payment, listing_id, amount_in_paise)
+            raise
+        
+        logger.info("Payment order created", extra=log_fields(LOG_SAMPLE_RATE, order_id=order['id'], demo_mode=demo_mode))
+        return {"order": order, "demo_mode": demo_mode}
         
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error creating payment order: {e}")
+    except Exception:
+        logger.exception("Error creating payment order")
         raise HTTPException(status_code=500, detail="Failed to create payment order")
 
 class PaymentVerification(BaseModel):
@@ -702,39 +3169,118 @@ class PaymentVerification(BaseModel):
     razorpay_payment_id: str
     razorpay_signature: str
 
+# Payment state transitions
+_transactions_supported = None
+
+def transactions_supported():
+    """Whether the connected deployment can run multi-document transactions"""
+    global _transactions_supported
+    if PAYMENT_TRANSACTIONS in ("on", "off"):
+        return PAYMENT_TRANSACTIONS == "on"
+    if _transactions_supported is None:
+        try:
+            hello = client.admin.command("hello")
+            _transactions_supported = bool(hello.get("setName") or hello.get("msg") == "isdbgrid")
+        except Exception:
+            logger.exception("Could not detect transaction support")
+            _transactions_supported = False
+    return _transactions_supported
+
+def activate_listing(listing_id, session=None):
+    """Activate a listing that is waiting for its payment
+
+    Only pending_payment listings move, so a listing the seller or an admin has since
+    deactivated or sold is never brought back by a late payment callback.
+    """
+    result = db.listings.update_one(
+        {"listing_id": listing_id, "status": "pending_payment"},
+        {"$set": {"status": "active", "updated_at": datetime.utcnow()}},
+        session=session
+    )
+    if session is None and result.modified_count:
+        # Transactional activations invalidate once the transaction has committed
+        catalogue_cache.invalidate()
+
+def complete_payment(razorpay_order_id, payment_fields):
+    """Move a payment from created to completed and activate its listing
+
+    The conditional update makes the transition happen exactly once, however many callbacks
+    race for it. Returns the completed payment, or None if it was not in the created state.
+    Without a transaction the transition records an outbox flag in the same write; a crash
+    before the listing update is repaired by reconcile_payments, which also clears the flags
+    in bulk so this path costs two writes.
+    """
+    now = datetime.utcnow()
+    update_fields = {"status": "completed", "updated_at": now, **payment_fields}
+
+    def transition(session=None, outbox=False):
+        fields = dict(update_fields, listing_activation_pending=True) if outbox else update_fields
+        payment = db.payments.find_one_and_update(
+            {"razorpay_order_id": razorpay_order_id, "status": "created"},
+            {"$set": fields},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if payment and payment.get("listing_id"):
+            activate_listing(payment["listing_id"], session=session)
+        return payment
+
+    if transactions_supported():
+        with client.start_session() as session:
+            payment = session.with_transaction(lambda s: transition(session=s))
+    else:
+        payment = transition(outbox=True)
+
+    if payment and payment.get("listing_id"):
+        # After the commit, so a concurrent request can't re-cache the pre-activation catalogue
+        catalogue_cache.invalidate()
+        queue_lead_fanout(payment["listing_id"])
+    return payment
+
+def resolve_repeated_payment(razorpay_order_id):
+    """Handle a verification for a payment that is no longer in the created state
+
+    Returns the payment if it is already completed (activating its listing if that is
+    still pending_payment), otherwise raises.
+    """
+    payment = db.payments.find_one({"razorpay_order_id": razorpay_order_id}, {"_id": 0})
+    if not payment:
+        raise HTTPException(status_code=400, detail="Payment not found")
+    if payment.get("status") != "completed":
+        raise HTTPException(status_code=400, detail=f"Payment is {payment.get('status')} and cannot be verified")
+    if payment.get("listing_id"):
+        activate_listing(payment["listing_id"])
+    return payment
+
 @app.post("/api/verify-payment")
+# Payment transition, listing activation and lead fan-out job; transactions add the commit
+# and, in "auto" mode, a one-off support probe
+@db_budget(3 if PAYMENT_TRANSACTIONS == "off" else 5)
 async def verify_payment(request: PaymentVerification, user_id: str = Depends(verify_jwt_token)):
-    """Verify Razorpay payment with demo mode support"""
+    """Verify Razorpay payment with demo mode support
+
+    Safe to retry: the payment moves from created to completed at most once.
+    """
     try:
-        # Find the payment record
-        payment = db.payments.find_one({"razorpay_order_id": request.razorpay_order_id})
-        if not payment:
-            raise HTTPException(status_code=400, detail="Payment not found")
+        check_db_connection()
+        payment_fields = {
+            "razorpay_payment_id": request.razorpay_payment_id,
+            "razorpay_signature": request.razorpay_signature
+        }
         
         # Check if this is a demo payment
-        if payment.get("demo_mode", False) or request.razorpay_order_id.startswith("order_demo_"):
-            print(f"Processing demo payment verification: {request.razorpay_order_id}")
+        if request.razorpay_order_id.startswith("order_demo_"):
+            logger.info("Processing demo payment verification", extra=log_fields(LOG_SAMPLE_RATE, order_id=request.razorpay_order_id))
             
-            # For demo mode, always verify successfully
-            # Update payment record
-            db.payments.update_one(
-                {"razorpay_order_id": request.razorpay_order_id},
-                {"$set": {
-                    "status": "completed",
-                    "razorpay_payment_id": request.razorpay_payment_id,
-                    "razorpay_signature": request.razorpay_signature,
-                    "updated_at": datetime.utcnow(),
-                    "demo_verified": True
-                }}
+            # For demo mode, always verify successfully; the transition invalidates the
+            # catalogue cache, so it runs off the event loop
+            payment = await asyncio.to_thread(
+                complete_payment, request.razorpay_order_id, dict(payment_fields, demo_verified=True)
             )
-            
-            # Activate listing
-            if payment["listing_id"]:
-                db.listings.update_one(
-                    {"listing_id": payment["listing_id"]},
-                    {"$set": {"status": "active", "updated_at": datetime.utcnow()}}
-                )
-                print(f"Listing {payment['listing_id']} activated via demo payment")
+            if not payment:
+                payment = await asyncio.to_thread(resolve_repeated_payment, request.razorpay_order_id)
+            logger.info("Listing activated", extra=log_fields(listing_id=payment.get('listing_id'), via="demo_payment"))
             
             return {"message": "Payment verified successfully (Demo Mode)", "demo_mode": True}
         
@@ -742,7 +3288,7 @@ async def verify_payment(request: PaymentVerification, user_id: str = Depends(ve
         if not razorpay_client:
             raise HTTPException(status_code=500, detail="Payment service not configured")
         
-        # Verify payment signature
+        # Verify payment signature (local HMAC check, no network call)
         params_dict = {
             'razorpay_order_id': request.razorpay_order_id,
             'razorpay_payment_id': request.razorpay_payment_id,
@@ -751,37 +3297,262 @@ async def verify_payment(request: PaymentVerification, user_id: str = Depends(ve
         
         try:
             razorpay_client.utility.verify_payment_signature(params_dict)
-            
-            # Update payment record
-            db.payments.update_one(
-                {"razorpay_order_id": request.razorpay_order_id},
-                {"$set": {
-                    "status": "completed",
-                    "razorpay_payment_id": request.razorpay_payment_id,
-                    "razorpay_signature": request.razorpay_signature,
-                    "updated_at": datetime.utcnow()
-                }}
-            )
-            
-            # Find and activate listing
-            if payment["listing_id"]:
-                db.listings.update_one(
-                    {"listing_id": payment["listing_id"]},
-                    {"$set": {"status": "active", "updated_at": datetime.utcnow()}}
-                )
-                print(f"Listing {payment['listing_id']} activated via real payment")
-            
-            return {"message": "Payment verified successfully", "demo_mode": False}
-        except Exception as e:
-            print(f"Payment verification failed: {e}")
+        except Exception:
+            # A bad signature is a client error, not a server fault; no traceback needed
+            logger.warning("Payment signature verification failed", extra=log_fields(order_id=request.razorpay_order_id))
             return {"message": "Payment verification failed"}
         
+        payment = await asyncio.to_thread(complete_payment, request.razorpay_order_id, payment_fields)
+        if not payment:
+            payment = await asyncio.to_thread(resolve_repeated_payment, request.razorpay_order_id)
+        logger.info("Listing activated", extra=log_fields(listing_id=payment.get('listing_id'), via="payment"))
+        
+        return {"message": "Payment verified successfully", "demo_mode": False}
+        
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error verifying payment: {e}")
+    except Exception:
+        logger.exception("Error verifying payment")
         raise HTTPException(status_code=500, detail="Failed to verify payment")
 
+# Razorpay webhooks
+def apply_razorpay_event(event):
+    """Apply the effects of a Razorpay webhook event, sharing the verify_payment transition"""
+    event_type = event.get("event")
+    if event_type not in ("payment.captured", "order.paid"):
+        return {"outcome": "ignored", "event": event_type}
+
+    payment_entity = event.get("payload", {}).get("payment", {}).get("entity", {})
+    order_id = payment_entity.get("order_id")
+    if not order_id:
+        return {"outcome": "ignored", "reason": "no order_id"}
+
+    payment = complete_payment(order_id, {
+        "razorpay_payment_id": payment_entity.get("id"),
+        "captured_via": "webhook"
+    })
+    if payment:
+        logger.info("Listing activated", extra=log_fields(listing_id=payment.get('listing_id'), via="razorpay_webhook"))
+        return {"outcome": "completed", "order_id": order_id, "listing_id": payment.get("listing_id")}
+
+    existing = db.payments.find_one({"razorpay_order_id": order_id}, {"_id": 0, "status": 1})
+    if not existing:
+        return {"outcome": "unknown_order", "order_id": order_id}
+    # verify_payment or reconciliation got there first and already activated the listing
+    return {"outcome": "already_" + str(existing.get("status")), "order_id": order_id}
+
+@job_handler("razorpay.webhook")
+def handle_razorpay_webhook(payload):
+    event_doc = db.payment_events.find_one({"_id": payload["event_id"]})
+    if not event_doc:
+        return {"outcome": "missing_event"}
+    result = apply_razorpay_event(event_doc["payload"])
+    db.payment_events.update_one(
+        {"_id": payload["event_id"]},
+        {"$set": {"status": "processed", "result": result, "processed_at": datetime.utcnow()}}
+    )
+    return result
+
+@app.post("/api/webhooks/razorpay")
+async def razorpay_webhook(http_request: Request):
+    """Receive Razorpay webhooks: verify, persist once per event ID, and process in the background"""
+    if not RAZORPAY_WEBHOOK_SECRET:
+        raise HTTPException(status_code=500, detail="Webhook secret not configured")
+
+    body = await http_request.body()
+    signature = http_request.headers.get("x-razorpay-signature", "")
+    expected = hmac.new(RAZORPAY_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, signature):
+        raise HTTPException(status_code=400, detail="Invalid webhook signature")
+
+    try:
+        event = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+
+    # Razorpay resends an event with the same ID until it gets a 2xx
+    event_id = http_request.headers.get("x-razorpay-event-id") or hashlib.sha256(body).hexdigest()
+    try:
+        check_db_connection()
+        db.payment_events.insert_one({
+            "_id": event_id,
+            "event": event.get("event"),
+            "payload": event,
+            "raw_body": body.decode("utf-8", errors="replace"),
+            "status": "received",
+            "received_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        return {"status": "duplicate", "event_id": event_id}
+    except Exception:
+        logger.exception("Error storing Razorpay webhook")
+        raise HTTPException(status_code=500, detail="Failed to store webhook")
+
+    try:
+        enqueue_job("razorpay.webhook", {"event_id": event_id}, priority=10)
+    except Exception as e:
+        # Forget the event so Razorpay's redelivery is not mistaken for a duplicate
+        logger.error("Error queueing Razorpay webhook", extra=log_fields(event_id=event_id, error=str(e)))
+        db.payment_events.delete_one({"_id": event_id})
+        raise HTTPException(status_code=500, detail="Failed to queue webhook")
+    return {"status": "accepted", "event_id": event_id}
+
+# Payment reconciliation
+def iter_batches(cursor, size):
+    """Group a streaming cursor into lists of at most `size` documents"""
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def fetch_provider_order(payment):
+    """Return (order status, captured payment id) for a stored payment from the provider"""
+    order_id = payment["razorpay_order_id"]
+    if RECONCILE_PROVIDER == "local" or payment.get("demo_mode") or order_id.startswith("order_demo_") or not razorpay_client:
+        # Demo orders never reach Razorpay; the stand-in reports what we already know
+        return "created", None
+    with track_provider_call("razorpay", "order.fetch"):
+        order = razorpay_client.order.fetch(order_id)
+    if order.get("status") != "paid":
+        return order.get("status"), None
+    with track_provider_call("razorpay", "order.payments"):
+        payments = razorpay_client.order.payments(order_id).get("items", [])
+    captured = next((item["id"] for item in payments if item.get("status") == "captured"), None)
+    return "paid", captured
+
+def reconcile_payments():
+    """Repair payments and listings that disagree, and report throughput
+
+    1. Outbox flags left by complete_payment are cleared in bulk, finishing the listing
+       activations a crash interrupted.
+    2. Listings still in pending_payment that have a completed payment are activated.
+    3. Unpaid orders past the checkout window are checked with the provider in parallel;
+       paid ones go through complete_payment like a verification or webhook would.
+    Steps 1 and 2 apply their fixes with unordered bulk writes, one per batch.
+    """
+    check_db_connection()
+    started = time.monotonic()
+    now = datetime.utcnow()
+    activated_listing_ids = []
+    report = {
+        "started_at": now,
+        "outbox_cleared": 0,
+        "outbox_repaired": 0,
+        "listings_scanned": 0,
+        "payments_scanned": 0,
+        "provider_lookups": 0,
+        "provider_errors": 0,
+        "payments_completed": 0,
+        "listings_activated": 0
+    }
+
+    # 1. complete_payment's outbox flags; most listings were activated right after the flag
+    # was written, and only those still pending are interrupted activations
+    outbox = db.payments.find(
+        {"listing_activation_pending": True},
+        {"_id": 0, "razorpay_order_id": 1, "listing_id": 1}
+    ).batch_size(RECONCILE_BATCH_SIZE)
+    for batch in iter_batches(outbox, RECONCILE_BATCH_SIZE):
+        listing_ids = [payment["listing_id"] for payment in batch if payment.get("listing_id")]
+        interrupted = db.listings.distinct(
+            "listing_id", {"listing_id": {"$in": listing_ids}, "status": "pending_payment"}
+        ) if listing_ids else []
+        if interrupted:
+            db.listings.update_many(
+                {"listing_id": {"$in": interrupted}, "status": "pending_payment"},
+                {"$set": {"status": "active", "updated_at": now}}
+            )
+            activated_listing_ids.extend(interrupted)
+            report["outbox_repaired"] += len(interrupted)
+        db.payments.update_many(
+            {"razorpay_order_id": {"$in": [payment["razorpay_order_id"] for payment in batch]}},
+            {"$unset": {"listing_activation_pending": ""}}
+        )
+        report["outbox_cleared"] += len(batch)
+
+    # 2. Listings left pending although their payment completed
+    pending_listings = db.listings.find(
+        {"status": "pending_payment"},
+        {"_id": 0, "listing_id": 1}
+    ).batch_size(RECONCILE_BATCH_SIZE)
+    for batch in iter_batches(pending_listings, RECONCILE_BATCH_SIZE):
+        report["listings_scanned"] += len(batch)
+        paid = db.payments.distinct(
+            "listing_id",
+            {"listing_id": {"$in": [listing["listing_id"] for listing in batch]}, "status": "completed"}
+        )
+        if paid:
+            result = db.listings.bulk_write([
+                UpdateOne(
+                    {"listing_id": listing_id, "status": "pending_payment"},
+                    {"$set": {"status": "active", "updated_at": now, "reconciled_at": now}}
+                )
+                for listing_id in paid
+            ], ordered=False)
+            report["listings_activated"] += result.modified_count
+            activated_listing_ids.extend(paid)
+
+    # 3. Orders stuck in created: ask the provider with bounded concurrency
+    stale_payments = db.payments.find(
+        {
+            "status": "created",
+            "created_at": {
+                "$gte": now - timedelta(days=RECONCILE_LOOKBACK_DAYS),
+                "$lte": now - timedelta(minutes=RECONCILE_STALE_MINUTES)
+            }
+        },
+        {"_id": 0, "razorpay_order_id": 1, "listing_id": 1, "demo_mode": 1}
+    ).batch_size(RECONCILE_BATCH_SIZE)
+    with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY, thread_name_prefix="reconcile") as executor:
+        for batch in iter_batches(stale_payments, RECONCILE_BATCH_SIZE):
+            report["payments_scanned"] += len(batch)
+            futures = [(payment, executor.submit(fetch_provider_order, payment)) for payment in batch]
+            for payment, future in futures:
+                report["provider_lookups"] += 1
+                try:
+                    status, captured_payment_id = future.result()
+                except Exception as e:
+                    report["provider_errors"] += 1
+                    logger.warning("Reconcile lookup failed", extra=log_fields(order_id=payment['razorpay_order_id'], error=str(e)))
+                    continue
+                if status != "paid":
+                    continue
+                # Paid orders are rare here; the shared transition invalidates the catalogue
+                # and queues the lead fan-out itself
+                completed = complete_payment(payment["razorpay_order_id"], {
+                    "razorpay_payment_id": captured_payment_id,
+                    "reconciled_at": now
+                })
+                if completed:
+                    report["payments_completed"] += 1
+                    if completed.get("listing_id"):
+                        report["listings_activated"] += 1
+
+    # Repaired listings get their broker leads like any other activation
+    if activated_listing_ids:
+        catalogue_cache.invalidate()
+    for listing_id in set(activated_listing_ids):
+        queue_lead_fanout(listing_id)
+
+    duration = time.monotonic() - started
+    scanned = report["payments_scanned"] + report["listings_scanned"] + report["outbox_cleared"]
+    report["duration_seconds"] = round(duration, 3)
+    report["records_per_second"] = round(scanned / duration, 1) if duration else scanned
+    db.reconciliation_runs.insert_one(dict(report))
+    logger.info("Payment reconciliation finished", extra=log_fields(**report))
+    report.pop("started_at")
+    return report
+
+@job_handler("payments.reconcile")
+def handle_payments_reconcile(payload):
+    return reconcile_payments()
+
+recurring_job("payments.reconcile", RECONCILE_INTERVAL_MINUTES * 60)
+
 @app.post("/api/broker-signup")
 async def broker_signup(broker: BrokerSignup):
     """Register a new broker"""
@@ -799,6 +3570,7 @@ async def broker_signup(broker: BrokerSignup):
             "phone_number": broker.phone_number,
             "email": broker.email,
             "location": broker.location,
+            "location_keys": location_keys(broker.location),
             "photo": broker.photo,
             "created_at": datetime.utcnow()
         }
@@ -806,8 +3578,8 @@ async def broker_signup(broker: BrokerSignup):
         db.brokers.insert_one(broker_data)
         
         return {"message": "Broker registered successfully", "broker_id": broker_id}
-    except Exception as e:
-        print(f"Error registering broker: {e}")
+    except Exception:
+        logger.exception("Error registering broker")
         raise HTTPException(status_code=500, detail="Failed to register broker")
 
 @app.get("/api/broker-profile")
@@ -835,12 +3607,13 @@ async def get_broker_profile(user_id: str = Depends(verify_jwt_token)):
         return {"broker": broker}
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error getting broker profile: {e}")
+    except Exception:
+        logger.exception("Error getting broker profile")
         raise HTTPException(status_code=500, detail="Failed to get broker profile")
 
 @app.get("/api/broker-dashboard")
-async def broker_dashboard(user_id: str = Depends(verify_jwt_token)):
+@db_budget(3)
+async def broker_dashboard(request: Request, user_id: str = Depends(verify_jwt_token)):
     """Get broker dashboard data"""
     try:
         # First check if broker is registered
@@ -856,17 +3629,378 @@ async def broker_dashboard(user_id: str = Depends(verify_jwt_token)):
         if not broker:
             raise HTTPException(status_code=404, detail="Broker not registered")
         
-        # Return active listings for registered broker
-        listings = list(db.listings.find({"status": "active"}))
-        for listing in listings:
-            listing['_id'] = str(listing['_id'])
-        return {"listings": listings}
+        # Registered brokers see the same active catalogue as the public listing page
+        return await catalogue_response(request)
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error getting broker dashboard: {e}")
+    except Exception:
+        logger.exception("Error getting broker dashboard")
         raise HTTPException(status_code=500, detail="Failed to get broker dashboard")
 
+# WhatsApp broadcasts
+broadcast_rate_limiter = TokenBucketLimiter("broadcast", f"{BROADCAST_RATE_PER_SECOND}/1")
+
+def broadcast_message(listing):
+    price = f"₹{listing.get('price')}" if listing.get('price') else ""
+    details = ", ".join(part for part in (listing.get('area'), price, listing.get('location')) if part)
+    message = f"New land listing on OnlyLands: {listing.get('title')}"
+    if details:
+        message += f" ({details})"
+    if listing.get('google_maps_link'):
+        message += f"\nMap: {listing['google_maps_link']}"
+    return message
+
+def broadcast_sender_configured():
+    return BROADCAST_PROVIDER == "log" or bool(twilio_client and TWILIO_WHATSAPP_FROM)
+
+def send_broadcast_message(phone_number, body):
+    """Send one WhatsApp message, waiting for rate-limit tokens and retrying provider throttling"""
+    if BROADCAST_PROVIDER == "log":
+        logger.info("WhatsApp stand-in", extra=log_fields(phone_number=phone_number, body=body))
+        return "logged"
+    if not broadcast_sender_configured():
+        raise RuntimeError("Twilio WhatsApp sender is not configured")
+    for attempt in range(1, BROADCAST_MAX_SEND_ATTEMPTS + 1):
+        wait = broadcast_rate_limiter.acquire("send")
+        while wait:
+            time.sleep(wait)
+            wait = broadcast_rate_limiter.acquire("send")
+        try:
+            with track_provider_call("twilio", "MessageList.create"):
+                message = twilio_client.messages.create(
+                    from_=f"whatsapp:{TWILIO_WHATSAPP_FROM}",
+                    to=f"whatsapp:{to_e164(phone_number)}",
+                    body=body
+                )
+            return message.sid
+        except TwilioRestException as e:
+            throttled = e.code == 20429 or e.status == 429
+            if not throttled or attempt == BROADCAST_MAX_SEND_ATTEMPTS:
+                raise
+            # Back off harder than the local limiter when Twilio says we are too fast
+            time.sleep(2 ** attempt)
+
+def fail_broadcast(broadcast_id, error):
+    """Mark a broadcast failed and release its listing so it can be broadcast again"""
+    db.broadcasts.update_one(
+        {"broadcast_id": broadcast_id},
+        {"$set": {"status": "failed", "error": error, "finished_at": datetime.utcnow()},
+         "$unset": {"open_listing_id": ""}}
+    )
+
+def run_broadcast(broadcast_id):
+    """Send a listing to every broker in its location and record per-broker delivery status"""
+    broadcast = db.broadcasts.find_one({"broadcast_id": broadcast_id})
+    if not broadcast:
+        return {"outcome": "missing_broadcast"}
+    listing = db.listings.find_one({"listing_id": broadcast["listing_id"]}, {"_id": 0})
+    if not listing or listing.get("status") != "active":
+        fail_broadcast(broadcast_id, "Listing not found" if not listing else "Listing is not active")
+        return {"outcome": "missing_listing" if not listing else "inactive_listing"}
+    if not broadcast_sender_configured():
+        # Nothing would be delivered; fail loudly rather than report brokers as reached
+        logger.error(
+            "Broadcast sender is not configured",
+            extra=log_fields(broadcast_id=broadcast_id, provider=BROADCAST_PROVIDER)
+        )
+        fail_broadcast(broadcast_id, "WhatsApp sender is not configured")
+        return {"outcome": "misconfigured"}
+
+    db.broadcasts.update_one(
+        {"broadcast_id": broadcast_id},
+        {"$set": {"status": "sending", "started_at": datetime.utcnow()}}
+    )
+    body = broadcast_message(listing)
+    # A retried job skips brokers that already have a delivery record
+    already_recorded = set(db.broadcast_deliveries.distinct("broker_id", {"broadcast_id": broadcast_id}))
+
+    brokers = db.brokers.find(
+        {"location_keys": {"$in": broadcast["location_keys"]}},
+        {"_id": 0, "broker_id": 1, "phone_number": 1}
+    ).batch_size(BROADCAST_BATCH_SIZE)
+
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix="broadcast") as executor:
+        for batch in iter_batches(brokers, BROADCAST_BATCH_SIZE):
+            batch = [broker for broker in batch if broker["broker_id"] not in already_recorded]
+            if not batch:
+                continue
+            futures = [(broker, executor.submit(send_broadcast_message, broker["phone_number"], body)) for broker in batch]
+            deliveries = []
+            for broker, future in futures:
+                delivery = {
+                    "broadcast_id": broadcast_id,
+                    "listing_id": listing["listing_id"],
+                    "broker_id": broker["broker_id"],
+                    "sent_at": datetime.utcnow()
+                }
+                try:
+                    delivery.update({"status": "sent", "provider_message_id": future.result()})
+                except Exception as e:
+                    delivery.update({"status": "failed", "error": str(e)[:300]})
+                deliveries.append(delivery)
+
+            # One insert and one counter update per batch rather than per broker; only rows
+            # that were actually inserted are counted, so a retried batch is not counted twice
+            rejected = set()
+            try:
+                db.broadcast_deliveries.insert_many(deliveries, ordered=False)
+            except BulkWriteError as e:
+                rejected = {error["index"] for error in e.details.get("writeErrors", [])}
+                logger.warning("Some broadcast deliveries were already recorded", extra=log_fields(inserted=e.details.get('nInserted')))
+            inserted = [delivery for index, delivery in enumerate(deliveries) if index not in rejected]
+            success_count = sum(1 for delivery in inserted if delivery["status"] == "sent")
+            db.broadcasts.update_one(
+                {"broadcast_id": broadcast_id},
+                {"$inc": {"success_count": success_count, "failed_count": len(inserted) - success_count},
+                 "$set": {"updated_at": datetime.utcnow()}}
+            )
+
+    # The delivery rows are the source of truth; recounting them repairs progress counters
+    # left short by a crash between a batch's insert and its counter update
+    counts = {row["_id"]: row["count"] for row in db.broadcast_deliveries.aggregate([
+        {"$match": {"broadcast_id": broadcast_id}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ])}
+    finished = db.broadcasts.find_one_and_update(
+        {"broadcast_id": broadcast_id},
+        {"$set": {
+            "status": "completed",
+            "success_count": counts.get("sent", 0),
+            "failed_count": counts.get("failed", 0),
+            "finished_at": datetime.utcnow()
+        }},
+        projection={"_id": 0, "success_count": 1, "failed_count": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if counts.get("sent"):
+        db.listings.update_one(
+            {"listing_id": listing["listing_id"]},
+            {"$set": {"broadcast_sent": True, "broadcast_at": datetime.utcnow()}}
+        )
+        db.broker_leads.update_many({"listing_id": listing["listing_id"]}, {"$set": {"broadcast_sent": True}})
+    return finished
+
+@job_handler("broadcast.send")
+def handle_broadcast_send(payload):
+    return run_broadcast(payload["broadcast_id"])
+
+def broadcast_progress(broadcast):
+    return {
+        "broadcast_id": broadcast["broadcast_id"],
+        "listing_id": broadcast["listing_id"],
+        "status": broadcast["status"],
+        "total_brokers": broadcast.get("total_brokers", 0),
+        "success_count": broadcast.get("success_count", 0),
+        "failed_count": broadcast.get("failed_count", 0)
+    }
+
+@app.post("/api/broadcast/{listing_id}")
+async def start_broadcast(listing_id: str, token: dict = Depends(verify_any_token)):
+    """Queue a WhatsApp broadcast of a listing to brokers in its location
+
+    Returns immediately; poll /api/broadcasts/{broadcast_id} for progress. Only paid (active)
+    listings are broadcast, once each: repeated calls return the existing broadcast.
+    """
+    try:
+        check_db_connection()
+        listing = db.listings.find_one({"listing_id": listing_id}, {"_id": 0, "seller_id": 1, "location": 1, "status": 1})
+        if not listing:
+            raise HTTPException(status_code=404, detail="Listing not found")
+        if token.get("user_type") != "admin" and listing.get("seller_id") != token.get("user_id"):
+            raise HTTPException(status_code=403, detail="Only the listing owner can broadcast it")
+        if listing.get("status") != "active":
+            raise HTTPException(status_code=400, detail="Only active listings can be broadcast")
+
+        existing = db.broadcasts.find_one({"open_listing_id": listing_id}, {"_id": 0})
+        if existing:
+            return dict(broadcast_progress(existing), message="Listing was already broadcast")
+
+        keys = listing_location_keys(listing.get("location"))
+        # Counted through the location_keys index, so this stays cheap for large broker lists
+        total_brokers = db.brokers.count_documents({"location_keys": {"$in": keys}}) if keys else 0
+        broadcast = {
+            "broadcast_id": str(uuid.uuid4()),
+            "listing_id": listing_id,
+            "location_keys": keys,
+            "status": "queued" if total_brokers else "completed",
+            "total_brokers": total_brokers,
+            "success_count": 0,
+            "failed_count": 0,
+            "requested_by": token.get("user_id") or token.get("username"),
+            "created_at": datetime.utcnow()
+        }
+        if total_brokers:
+            # An empty broadcast sent nothing, so it does not use up the listing's one broadcast
+            broadcast["open_listing_id"] = listing_id
+        try:
+            db.broadcasts.insert_one(dict(broadcast))
+        except DuplicateKeyError:
+            # A concurrent request queued this listing's broadcast first
+            existing = db.broadcasts.find_one({"open_listing_id": listing_id}, {"_id": 0})
+            if not existing:
+                raise
+            return dict(broadcast_progress(existing), message="Listing was already broadcast")
+        if total_brokers:
+            try:
+                enqueue_job("broadcast.send", {"broadcast_id": broadcast["broadcast_id"]}, priority=5)
+            except Exception:
+                fail_broadcast(broadcast["broadcast_id"], "Failed to queue broadcast")
+                raise
+
+        return dict(broadcast_progress(broadcast), message="Broadcast queued" if total_brokers else "No brokers in this location")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error starting broadcast")
+        raise HTTPException(status_code=500, detail="Failed to start broadcast")
+
+@app.get("/api/broadcasts/{broadcast_id}")
+async def get_broadcast(broadcast_id: str, token: dict = Depends(verify_any_token)):
+    """Poll the progress of a broadcast"""
+    try:
+        broadcast = db.broadcasts.find_one({"broadcast_id": broadcast_id}, {"_id": 0})
+        if not broadcast:
+            raise HTTPException(status_code=404, detail="Broadcast not found")
+        return broadcast_progress(broadcast)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error getting broadcast")
+        raise HTTPException(status_code=500, detail="Failed to get broadcast")
+
+# Broker lead inbox
+# Leads are written once per (broker, listing) when a listing goes live, so reading an
+# inbox is a single indexed range scan instead of matching locations on every request.
+def queue_lead_fanout(listing_id):
+    """Queue lead creation for a newly active listing without failing the caller"""
+    try:
+        enqueue_job("leads.fanout", {"listing_id": listing_id}, priority=5, dedupe_key=f"leads.fanout:{listing_id}")
+    except Exception:
+        logger.exception("Failed to queue lead fan-out", extra=log_fields(listing_id=listing_id))
+
+def fan_out_listing_leads(listing_id):
+    """Insert a lead for every broker whose locations match an active listing"""
+    listing = db.listings.find_one({"listing_id": listing_id}, {"_id": 0})
+    if not listing or listing.get("status") != "active":
+        return {"outcome": "skipped", "leads_created": 0}
+    keys = listing_location_keys(listing.get("location"))
+    if not keys:
+        return {"outcome": "no_location", "leads_created": 0}
+
+    now = datetime.utcnow()
+    lead_fields = {
+        "listing_id": listing_id,
+        "seller_id": listing.get("seller_id"),
+        "title": listing.get("title"),
+        "area": listing.get("area"),
+        "price": listing.get("price"),
+        "location": listing.get("location"),
+        "google_maps_link": listing.get("google_maps_link"),
+        "photo": (listing.get("photos") or [None])[0],
+        "photo_placeholder": (listing.get("photo_placeholders") or [None])[0],
+        "status": listing.get("status"),
+        "payment_status": "completed",
+        "broadcast_sent": bool(listing.get("broadcast_sent")),
+        "read": False,
+        "created_at": now
+    }
+    brokers = db.brokers.find(
+        {"location_keys": {"$in": keys}},
+        {"_id": 0, "broker_id": 1}
+    ).batch_size(LEADS_BATCH_SIZE)
+
+    leads_created = 0
+    for batch in iter_batches(brokers, LEADS_BATCH_SIZE):
+        leads = [dict(lead_fields, lead_id=str(uuid.uuid4()), broker_id=broker["broker_id"]) for broker in batch]
+        try:
+            leads_created += len(db.broker_leads.insert_many(leads, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            # Retried fan-outs hit the (broker_id, listing_id) unique index; the rest still land
+            leads_created += e.details.get("nInserted", 0)
+    return {"outcome": "done", "leads_created": leads_created}
+
+@job_handler("leads.fanout")
+def handle_leads_fanout(payload):
+    return fan_out_listing_leads(payload["listing_id"])
+
+def authorize_broker_access(broker_id, token):
+    """Allow admins, or the user whose phone number owns the broker profile"""
+    if token.get("user_type") == "admin":
+        return
+    broker = db.brokers.find_one(
+        {"broker_id": broker_id, "phone_number": token.get("phone_number")},
+        {"_id": 1}
+    )
+    if not broker:
+        raise HTTPException(status_code=403, detail="Not allowed to view these leads")
+
+@app.get("/api/brokers/{broker_id}/leads")
+async def get_broker_leads(
+    broker_id: str,
+    limit: int = LEADS_PAGE_SIZE,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    token: dict = Depends(verify_any_token)
+):
+    """Newest-first page of a broker's leads
+
+    Pass next_before and next_before_id back as `before` and `before_id` for the next page.
+    Leads from one fan-out share created_at, so the lead_id tie-breaker keeps pages from
+    skipping or repeating them.
+    """
+    try:
+        check_db_connection()
+        authorize_broker_access(broker_id, token)
+        limit = max(1, min(limit, LEADS_MAX_PAGE_SIZE))
+
+        query = {"broker_id": broker_id}
+        if before and before_id:
+            query["$or"] = [
+                {"created_at": {"$lt": before}},
+                {"created_at": before, "lead_id": {"$lt": before_id}}
+            ]
+        elif before:
+            query["created_at"] = {"$lt": before}
+        leads = list(
+            db.broker_leads.find(query, {"_id": 0})
+            .sort([("created_at", DESCENDING), ("lead_id", DESCENDING)])
+            .limit(limit)
+        )
+        unread_count = db.broker_leads.count_documents({"broker_id": broker_id, "read": False})
+
+        next_before = next_before_id = None
+        if len(leads) == limit:
+            next_before = leads[-1]["created_at"].isoformat()
+            next_before_id = leads[-1]["lead_id"]
+        return {
+            "leads": leads,
+            "unread_count": unread_count,
+            "next_before": next_before,
+            "next_before_id": next_before_id
+        }
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error getting broker leads")
+        raise HTTPException(status_code=500, detail="Failed to get broker leads")
+
+@app.post("/api/brokers/{broker_id}/leads/read")
+async def mark_broker_leads_read(broker_id: str, request: dict, token: dict = Depends(verify_any_token)):
+    """Mark the given lead_ids (or every lead when none are given) as read"""
+    try:
+        check_db_connection()
+        authorize_broker_access(broker_id, token)
+        query = {"broker_id": broker_id, "read": False}
+        if request.get("lead_ids"):
+            query["lead_id"] = {"$in": request["lead_ids"]}
+        result = db.broker_leads.update_many(query, {"$set": {"read": True, "read_at": datetime.utcnow()}})
+        return {"message": "Leads marked as read", "updated": result.modified_count}
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error marking broker leads read")
+        raise HTTPException(status_code=500, detail="Failed to update broker leads")
+
 # Admin routes
 @app.post("/api/admin/login")
 async def admin_login(request: AdminLogin):
@@ -882,81 +4016,103 @@ async def admin_login(request: AdminLogin):
             return {"message": "Admin login successful", "token": token}
         else:
             raise HTTPException(status_code=401, detail="Invalid credentials")
-    except Exception as e:
-        print(f"Error in admin login: {e}")
+    except Exception:
+        logger.exception("Error in admin login")
         raise HTTPException(status_code=500, detail="Login failed")
 
+@app.get("/api/admin/db-profile")
+async def admin_db_profile(limit: int = 50, admin: dict = Depends(verify_admin_token)):
+    """Slowest MongoDB query shapes and recent slow operations with explain summaries"""
+    if not MONGO_PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Query profiler is disabled")
+    return MongoJSONResponse(query_profiler.report(max(1, min(limit, 500))))
+
+@app.get("/api/admin/traces")
+async def admin_traces(
+    route: Optional[str] = None,
+    min_ms: float = 0,
+    limit: int = 50,
+    admin: dict = Depends(verify_admin_token)
+):
+    """Recent sampled and slow request traces, newest first"""
+    traces = [
+        trace for trace in reversed(recent_traces)
+        if trace["duration_ms"] >= min_ms and (route is None or trace["route"] == route)
+    ]
+    return MongoJSONResponse({
+        "sample_rate": TRACE_SAMPLE_RATE,
+        "slow_threshold_ms": TRACE_SLOW_MS,
+        "traces": traces[:max(1, min(limit, TRACE_BUFFER_SIZE))]
+    })
+
+def count_by_status(collection):
+    """Document counts per status in one round trip"""
+    return {
+        row["_id"]: row["count"]
+        for row in collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])
+    }
+
 @app.get("/api/admin/stats")
+@db_budget(4)
 async def admin_stats(admin: dict = Depends(verify_admin_token)):
     """Get admin dashboard statistics"""
     try:
         total_users = db.users.count_documents({})
-        total_listings = db.listings.count_documents({})
-        active_listings = db.listings.count_documents({"status": "active"})
-        pending_listings = db.listings.count_documents({"status": "pending_payment"})
+        listing_counts = count_by_status(db.listings)
         total_brokers = db.brokers.count_documents({})
-        total_payments = db.payments.count_documents({})
-        completed_payments = db.payments.count_documents({"status": "completed"})
+        payment_counts = count_by_status(db.payments)
         
         return {
             "total_users": total_users,
-            "total_listings": total_listings,
-            "active_listings": active_listings,
-            "pending_listings": pending_listings,
+            "total_listings": sum(listing_counts.values()),
+            "active_listings": listing_counts.get("active", 0),
+            "pending_listings": listing_counts.get("pending_payment", 0),
             "total_brokers": total_brokers,
-            "total_payments": total_payments,
-            "completed_payments": completed_payments
+            "total_payments": sum(payment_counts.values()),
+            "completed_payments": payment_counts.get("completed", 0)
         }
-    except Exception as e:
-        print(f"Error getting admin stats: {e}")
+    except Exception:
+        logger.exception("Error getting admin stats")
         raise HTTPException(status_code=500, detail="Failed to get admin stats")
 
 @app.get("/api/admin/users")
 async def admin_users(admin: dict = Depends(verify_admin_token)):
     """Get all users for admin"""
     try:
-        users = list(db.users.find({}))
-        for user in users:
-            user['_id'] = str(user['_id'])
-        return {"users": users}
-    except Exception as e:
-        print(f"Error getting admin users: {e}")
+        users = list(db.users.find({}, {"_id": 0}))
+        return MongoJSONResponse({"users": users})
+    except Exception:
+        logger.exception("Error getting admin users")
         raise HTTPException(status_code=500, detail="Failed to get users")
 
 @app.get("/api/admin/listings")
 async def admin_listings(admin: dict = Depends(verify_admin_token)):
     """Get all listings for admin"""
     try:
-        listings = list(db.listings.find({}))
-        for listing in listings:
-            listing['_id'] = str(listing['_id'])
-        return {"listings": listings}
-    except Exception as e:
-        print(f"Error getting admin listings: {e}")
+        listings = list(db.listings.find({}, {"_id": 0}))
+        return MongoJSONResponse({"listings": listings})
+    except Exception:
+        logger.exception("Error getting admin listings")
         raise HTTPException(status_code=500, detail="Failed to get listings")
 
 @app.get("/api/admin/brokers")
 async def admin_brokers(admin: dict = Depends(verify_admin_token)):
     """Get all brokers for admin"""
     try:
-        brokers = list(db.brokers.find({}))
-        for broker in brokers:
-            broker['_id'] = str(broker['_id'])
-        return {"brokers": brokers}
-    except Exception as e:
-        print(f"Error getting admin brokers: {e}")
+        brokers = list(db.brokers.find({}, {"_id": 0}))
+        return MongoJSONResponse({"brokers": brokers})
+    except Exception:
+        logger.exception("Error getting admin brokers")
         raise HTTPException(status_code=500, detail="Failed to get brokers")
 
 @app.get("/api/admin/payments")
 async def admin_payments(admin: dict = Depends(verify_admin_token)):
     """Get all payments for admin"""
     try:
-        payments = list(db.payments.find({}))
-        for payment in payments:
-            payment['_id'] = str(payment['_id'])
-        return {"payments": payments}
-    except Exception as e:
-        print(f"Error getting admin payments: {e}")
+        payments = list(db.payments.find({}, {"_id": 0}))
+        return MongoJSONResponse({"payments": payments})
+    except Exception:
+        logger.exception("Error getting admin payments")
         raise HTTPException(status_code=500, detail="Failed to get payments")
 
 @app.delete("/api/admin/delete-listing/{listing_id}")
@@ -966,9 +4122,11 @@ async def delete_listing(listing_id: str, admin: dict = Depends(verify_admin_tok
         result = db.listings.delete_one({"listing_id": listing_id})
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Listing not found")
+        db.broker_leads.delete_many({"listing_id": listing_id})
+        await asyncio.to_thread(catalogue_cache.invalidate)
         return {"message": "Listing deleted successfully"}
-    except Exception as e:
-        print(f"Error deleting listing: {e}")
+    except Exception:
+        logger.exception("Error deleting listing")
         raise HTTPException(status_code=500, detail="Failed to delete listing")
 
 @app.put("/api/admin/update-listing/{listing_id}")
@@ -977,6 +4135,8 @@ async def update_listing(listing_id: str, listing_data: dict, admin: dict = Depe
     try:
         # Remove fields that shouldn't be updated
         update_data = {k: v for k, v in listing_data.items() if k not in ['_id', 'listing_id', 'created_at']}
+        if "photos" in update_data:
+            update_data["cover_photo"] = cover_photo_of(update_data["photos"])
         
         result = db.listings.update_one(
             {"listing_id": listing_id},
@@ -985,34 +4145,158 @@ async def update_listing(listing_id: str, listing_data: dict, admin: dict = Depe
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Listing not found")
-            
+        
+        await asyncio.to_thread(catalogue_cache.invalidate)
         return {"message": "Listing updated successfully"}
-    except Exception as e:
-        print(f"Error updating listing: {e}")
+    except Exception:
+        logger.exception("Error updating listing")
         raise HTTPException(status_code=500, detail="Failed to update listing")
 
+# Seller contact lookups
+class ContactEventBuffer:
+    """Collects contact clicks in memory and writes them with insert_many"""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, event):
+        """Queue an event; returns True once a full batch is waiting"""
+        with self.lock:
+            self.events.append(event)
+            return len(self.events) >= self.batch_size
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+        if events and db is not None:
+            try:
+                db.contact_events.insert_many(events, ordered=False)
+            except Exception:
+                logger.exception("Failed to record contact events", extra=log_fields(events=len(events)))
+        return len(events)
+
+contact_event_buffer = ContactEventBuffer(CONTACT_EVENT_BATCH_SIZE)
+contact_event_flusher = None
+
+async def record_contact_click(viewer_id, seller_id, source="lookup"):
+    """Record that a viewer contacted a seller ("lookup" from the backend, "cached_click" from the frontend cache)"""
+    event = {"viewer_id": viewer_id, "seller_id": seller_id, "source": source, "created_at": datetime.utcnow()}
+    if contact_event_buffer.add(event):
+        await asyncio.to_thread(contact_event_buffer.flush)
+
+async def flush_contact_events_periodically():
+    while True:
+        await asyncio.sleep(CONTACT_EVENT_FLUSH_SECONDS)
+        await asyncio.to_thread(contact_event_buffer.flush)
+
+@app.on_event("startup")
+async def start_contact_event_flusher():
+    global contact_event_flusher
+    # Keep a reference: the loop only holds tasks weakly
+    contact_event_flusher = asyncio.create_task(flush_contact_events_periodically())
+
+@app.on_event("shutdown")
+async def flush_contact_events_on_shutdown():
+    if contact_event_flusher is not None:
+        contact_event_flusher.cancel()
+        try:
+            await contact_event_flusher
+        except asyncio.CancelledError:
+            pass
+    await asyncio.to_thread(contact_event_buffer.flush)
+
+def lookup_seller_phones(seller_ids):
+    """Resolve seller_ids to phone numbers from the cache, fetching misses in one $in query"""
+    phones = {}
+    misses = []
+    for seller_id in seller_ids:
+        phone = seller_phone_cache.get(seller_id)
+        if phone:
+            phones[seller_id] = phone
+        else:
+            misses.append(seller_id)
+    if misses:
+        for user in db.users.find({"user_id": {"$in": misses}}, {"_id": 0, "user_id": 1, "phone_number": 1}):
+            if user.get("phone_number"):
+                phones[user["user_id"]] = user["phone_number"]
+                seller_phone_cache.set(user["user_id"], user["phone_number"])
+    return phones
+
 @app.get("/api/seller-phone/{seller_id}")
+@db_budget(2)
 async def get_seller_phone(seller_id: str, token: str = Depends(verify_jwt_token)):
     """Get seller phone number for WhatsApp contact"""
     try:
-        # Find user by seller_id
-        user = db.users.find_one({"user_id": seller_id})
-        if not user:
-            raise HTTPException(status_code=404, detail="Seller not found")
-        
-        # Return phone number
-        phone_number = user.get('phone_number')
+        check_db_connection()
+        phone_number = lookup_seller_phones([seller_id]).get(seller_id)
         if not phone_number:
+            # Distinguish a missing seller from one without a phone number, as before
+            if not db.users.find_one({"user_id": seller_id}, {"_id": 1}):
+                raise HTTPException(status_code=404, detail="Seller not found")
             raise HTTPException(status_code=404, detail="Phone number not available")
-            
+        
+        await record_contact_click(token, seller_id)
         return {"phone_number": phone_number}
     except HTTPException:
         # Re-raise HTTP exceptions (like 404)
         raise
-    except Exception as e:
-        print(f"Error getting seller phone: {e}")
+    except Exception:
+        logger.exception("Error getting seller phone")
         raise HTTPException(status_code=500, detail="Failed to get seller phone")
 
+@app.post("/api/seller-phones")
+@db_budget(1)
+async def get_seller_phones(request: dict, token: str = Depends(verify_jwt_token)):
+    """Resolve many seller_ids to phone numbers in one call (for lead cards on screen)
+
+    This is a prefetch, not a contact: the frontend reports the clicks it serves from these
+    numbers through /api/contact-events.
+    """
+    try:
+        seller_ids = request.get("seller_ids") or []
+        if not isinstance(seller_ids, list) or not all(isinstance(seller_id, str) for seller_id in seller_ids):
+            raise HTTPException(status_code=400, detail="seller_ids must be a list of strings")
+        if len(seller_ids) > SELLER_PHONE_BATCH_MAX:
+            raise HTTPException(status_code=400, detail=f"At most {SELLER_PHONE_BATCH_MAX} seller_ids per request")
+        
+        check_db_connection()
+        unique_ids = list(dict.fromkeys(seller_ids))
+        phone_numbers = lookup_seller_phones(unique_ids)
+        missing = [seller_id for seller_id in unique_ids if seller_id not in phone_numbers]
+        return {"phone_numbers": phone_numbers, "missing": missing}
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error getting seller phones")
+        raise HTTPException(status_code=500, detail="Failed to get seller phones")
+
+@app.post("/api/contact-events")
+async def record_contact_events(request: dict, token: str = Depends(verify_jwt_token)):
+    """Record contact clicks the frontend served from its own phone cache"""
+    seller_ids = request.get("seller_ids") or []
+    if not isinstance(seller_ids, list) or not all(isinstance(seller_id, str) for seller_id in seller_ids):
+        raise HTTPException(status_code=400, detail="seller_ids must be a list of strings")
+    if len(seller_ids) > SELLER_PHONE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {SELLER_PHONE_BATCH_MAX} seller_ids per request")
+    
+    for seller_id in seller_ids:
+        await record_contact_click(token, seller_id, source="cached_click")
+    return {"recorded": len(seller_ids)}
+
+@app.on_event("shutdown")
+def shutdown_media_pool():
+    """Stop media worker processes with the app"""
+    if _media_pool is not None:
+        _media_pool.shutdown(wait=False, cancel_futures=True)
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        run_job_worker()
+    elif len(sys.argv) > 1 and sys.argv[1] == "reconcile":
+        ensure_indexes()
+        reconcile_payments()
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
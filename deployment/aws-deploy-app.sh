@@ -110,11 +110,25 @@ module.exports = {
     watch: false,
     max_memory_restart: '1G',
     env: {
-      NODE_ENV: 'production'
+      NODE_ENV: 'production',
+      // nginx plus the load balancer's VPC, so X-Forwarded-For yields the real client IP
+      TRUSTED_PROXIES: '127.0.0.1,::1,172.31.0.0/16'
     },
     error_file: '/var/www/onlylands/logs/backend-error.log',
     out_file: '/var/www/onlylands/logs/backend-out.log',
     log_file: '/var/www/onlylands/logs/backend-combined.log'
+  }, {
+    name: 'onlylands-worker',
+    script: 'venv/bin/python',
+    args: 'server.py worker',
+    cwd: '/var/www/onlylands/backend',
+    instances: 1,
+    autorestart: true,
+    watch: false,
+    max_memory_restart: '1G',
+    error_file: '/var/www/onlylands/logs/worker-error.log',
+    out_file: '/var/www/onlylands/logs/worker-out.log',
+    log_file: '/var/www/onlylands/logs/worker-combined.log'
   }]
 };
 EOF
@@ -1,5 +1,6 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
+import { getSellerPhone, createVisibleSellerPrefetcher } from './sellerContacts';
 import LoginChoice from './LoginChoice';
 import OTPLogin from './OTPLogin';
 import EnhancedListingsView from './EnhancedListingsView';
@@ -1618,11 +1619,18 @@ function BrokerDashboard({ user }) {
     email: '',
     location: ''
   });
+  const phonePrefetcher = useRef(null);
 
   useEffect(() => {
     checkBrokerRegistration();
   }, []);
 
+  // Resolve seller phones only for lead cards that are actually on screen
+  useEffect(() => {
+    phonePrefetcher.current = createVisibleSellerPrefetcher(localStorage.getItem('token'));
+    return () => phonePrefetcher.current.disconnect();
+  }, []);
+
   const checkBrokerRegistration = async () => {
     console.log('🔍 Starting broker registration check...');
     try {
@@ -1908,25 +1916,16 @@ function BrokerDashboard({ user }) {
         return;
       }
       
-      // Get seller phone number from backend
-      const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/api/seller-phone/${listing.seller_id}`, {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
-      
-      if (!response.ok) {
-        if (response.status === 404) {
-          alert('Contact information not available for this listing.');
-        } else {
-          alert('Unable to get contact information. Please try again.');
-        }
+      // Get seller phone number (cached per viewer, otherwise from backend)
+      let phoneNumber;
+      try {
+        phoneNumber = await getSellerPhone(token, listing.seller_id);
+      } catch (error) {
+        console.error('Error getting seller phone:', error);
+        alert('Unable to get contact information. Please try again.');
         return;
       }
       
-      const data = await response.json();
-      const phoneNumber = data.phone_number;
-      
       if (!phoneNumber) {
         alert('Contact information not available for this listing.');
         return;
@@ -1969,7 +1968,12 @@ function BrokerDashboard({ user }) {
             </div>
           ) : (
             leads.map((listing) => (
-              <div key={listing.listing_id} className="bg-white rounded-lg shadow-md p-6 hover:shadow-lg transition-shadow">
+              <div
+                key={listing.listing_id}
+                data-seller-id={listing.seller_id}
+                ref={(element) => phonePrefetcher.current && phonePrefetcher.current.observe(element)}
+                className="bg-white rounded-lg shadow-md p-6 hover:shadow-lg transition-shadow"
+              >
                 <div className="mb-4">
                   <h3 className="text-lg font-bold text-gray-800 mb-2">{listing.title}</h3>
                   <div className="mb-2">
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import axios from 'axios';
+import { getSellerPhone } from './sellerContacts';
 
 const EnhancedListingsView = ({ setCurrentView }) => {
   const [listings, setListings] = useState([]);
@@ -88,10 +89,12 @@ const EnhancedListingsView = ({ setCurrentView }) => {
     setPriceRange('');
   };
 
-  const getImageSrc = (imageData) => {
+  const getImageSrc = (imageData, width) => {
     // Handle local file URLs (starts with /api/uploads/)
     if (typeof imageData === 'string' && imageData.startsWith('/api/uploads/')) {
-      return `${process.env.REACT_APP_BACKEND_URL}${imageData}`;
+      // Ask the backend for a resized WebP variant instead of the full-size original
+      const variant = width ? `?w=${width}&fmt=webp` : '';
+      return `${process.env.REACT_APP_BACKEND_URL}${imageData}${variant}`;
     }
     
     // Handle S3 URLs (string format with https://)
@@ -108,6 +111,12 @@ const EnhancedListingsView = ({ setCurrentView }) => {
     return '/placeholder-land.jpg';
   };
 
+  const getVideoPoster = (listing, videoUrl) => {
+    // Posters are extracted in the background after upload, so they may not exist yet
+    const meta = listing?.video_meta?.find((video) => video.url === videoUrl);
+    return meta?.poster ? getImageSrc(meta.poster, 1280) : undefined;
+  };
+
   const openWhatsApp = async (listing) => {
     try {
       // Get auth token from localStorage - FIXED: changed from 'authToken' to 'token'
@@ -117,25 +126,16 @@ const EnhancedListingsView = ({ setCurrentView }) => {
         return;
       }
       
-      // Get seller phone number from backend
-      const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/api/seller-phone/${listing.seller_id}`, {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
-      
-      if (!response.ok) {
-        if (response.status === 404) {
-          alert('Contact information not available for this listing.');
-        } else {
-          alert('Unable to get contact information. Please try again.');
-        }
+      // Get seller phone number (cached per viewer, otherwise from backend)
+      let phoneNumber;
+      try {
+        phoneNumber = await getSellerPhone(token, listing.seller_id);
+      } catch (error) {
+        console.error('Error getting seller phone:', error);
+        alert('Unable to get contact information. Please try again.');
         return;
       }
       
-      const data = await response.json();
-      const phoneNumber = data.phone_number;
-      
       if (!phoneNumber) {
         alert('Contact information not available for this listing.');
         return;
@@ -304,10 +304,15 @@ const EnhancedListingsView = ({ setCurrentView }) => {
               {/* Image Slider */}
               <div className="relative h-48 bg-gray-200 overflow-hidden">
                 {listing.photos && listing.photos.length > 0 ? (
-                  <div className="relative w-full h-full">
+                  <div
+                    className="relative w-full h-full bg-cover bg-center"
+                    style={listing.photo_placeholders?.[0] ? { backgroundImage: `url(${listing.photo_placeholders[0]})` } : undefined}
+                  >
                     <img
-                      src={getImageSrc(listing.photos[0])}
+                      src={getImageSrc(listing.photos[0], 640)}
                       alt={listing.title}
+                      loading="lazy"
+                      decoding="async"
                       className="w-full h-full object-cover"
                       onError={(e) => {
                         e.target.src = '/placeholder-land.jpg';
@@ -433,7 +438,7 @@ const EnhancedListingsView = ({ setCurrentView }) => {
                         if (currentMedia.type === 'image') {
                           return (
                             <img
-                              src={getImageSrc(currentMedia.src)}
+                              src={getImageSrc(currentMedia.src, 1280)}
                               alt={selectedListing.title}
                               className="w-full h-full object-cover"
                               onError={(e) => {
@@ -445,6 +450,8 @@ const EnhancedListingsView = ({ setCurrentView }) => {
                           return (
                             <video
                               src={getImageSrc(currentMedia.src)}
+                              poster={getVideoPoster(selectedListing, currentMedia.src)}
+                              preload="metadata"
                               controls
                               className="w-full h-full object-cover"
                             >
@@ -564,7 +571,7 @@ const EnhancedListingsView = ({ setCurrentView }) => {
                         >
                           {media.type === 'image' ? (
                             <img
-                              src={getImageSrc(media.src)}
+                              src={getImageSrc(media.src, 160)}
                               alt={`${selectedListing.title} ${index + 1}`}
                               className="w-full h-16 object-cover"
                             />
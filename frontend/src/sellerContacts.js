@@ -0,0 +1,154 @@
+// Seller phone lookups shared by the broker dashboard and the listings view.
+// Phones are cached per viewer (keyed by token) so repeat clicks skip the backend,
+// and clicks served from the cache are reported to the backend in batches.
+// Prefetching is limited to cards on screen and is never reported as a contact.
+
+const backendUrl = process.env.REACT_APP_BACKEND_URL || '';
+const CACHE_TTL_MS = 5 * 60 * 1000;
+const BATCH_MAX = 100;
+const CLICK_FLUSH_DELAY_MS = 2000;
+const PREFETCH_DELAY_MS = 300;
+
+const phoneCache = new Map();
+let pendingClicks = [];
+let pendingClicksToken = null;
+let flushTimer = null;
+
+const cacheKey = (token, sellerId) => `${token}:${sellerId}`;
+
+const getCachedPhone = (token, sellerId) => {
+  const entry = phoneCache.get(cacheKey(token, sellerId));
+  if (!entry) return null;
+  if (entry.expiresAt < Date.now()) {
+    phoneCache.delete(cacheKey(token, sellerId));
+    return null;
+  }
+  return entry.phoneNumber;
+};
+
+const setCachedPhone = (token, sellerId, phoneNumber) => {
+  phoneCache.set(cacheKey(token, sellerId), { phoneNumber, expiresAt: Date.now() + CACHE_TTL_MS });
+};
+
+const flushContactClicks = () => {
+  if (flushTimer) {
+    clearTimeout(flushTimer);
+    flushTimer = null;
+  }
+  if (pendingClicks.length === 0) return;
+
+  const sellerIds = pendingClicks;
+  const token = pendingClicksToken;
+  pendingClicks = [];
+  // keepalive lets the request finish when the page is being closed
+  fetch(`${backendUrl}/api/contact-events`, {
+    method: 'POST',
+    keepalive: true,
+    headers: {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${token}`
+    },
+    body: JSON.stringify({ seller_ids: sellerIds })
+  }).catch((error) => console.error('Error recording contact clicks:', error));
+};
+
+const recordContactClick = (token, sellerId) => {
+  if (pendingClicksToken !== token) flushContactClicks();
+  pendingClicksToken = token;
+  pendingClicks.push(sellerId);
+  if (pendingClicks.length >= BATCH_MAX) {
+    flushContactClicks();
+  } else if (!flushTimer) {
+    flushTimer = setTimeout(flushContactClicks, CLICK_FLUSH_DELAY_MS);
+  }
+};
+
+if (typeof window !== 'undefined') {
+  window.addEventListener('pagehide', flushContactClicks);
+}
+
+// Resolve the sellers of a page of listings in one request
+export const prefetchSellerPhones = async (token, sellerIds) => {
+  const missing = [...new Set(sellerIds.filter(Boolean))].filter((id) => !getCachedPhone(token, id));
+  for (let i = 0; i < missing.length; i += BATCH_MAX) {
+    try {
+      const response = await fetch(`${backendUrl}/api/seller-phones`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': `Bearer ${token}`
+        },
+        body: JSON.stringify({ seller_ids: missing.slice(i, i + BATCH_MAX) })
+      });
+      if (!response.ok) return;
+      const data = await response.json();
+      Object.entries(data.phone_numbers || {}).forEach(([sellerId, phoneNumber]) => {
+        setCachedPhone(token, sellerId, phoneNumber);
+      });
+    } catch (error) {
+      // Prefetching is best effort; clicks fall back to a single lookup
+      console.error('Error prefetching seller phones:', error);
+      return;
+    }
+  }
+};
+
+// Prefetch phones for cards as they scroll into view. Cards opt in with a
+// data-seller-id attribute and are passed to observe(); sellers that became
+// visible close together are resolved in one batch request.
+export const createVisibleSellerPrefetcher = (token) => {
+  if (typeof IntersectionObserver === 'undefined') {
+    return { observe: () => {}, disconnect: () => {} };
+  }
+  let queued = new Set();
+  let timer = null;
+
+  const flush = () => {
+    timer = null;
+    const sellerIds = [...queued];
+    queued = new Set();
+    prefetchSellerPhones(token, sellerIds);
+  };
+
+  const observer = new IntersectionObserver((entries) => {
+    entries.forEach((entry) => {
+      if (!entry.isIntersecting) return;
+      observer.unobserve(entry.target);
+      if (entry.target.dataset.sellerId) queued.add(entry.target.dataset.sellerId);
+    });
+    if (queued.size > 0 && !timer) timer = setTimeout(flush, PREFETCH_DELAY_MS);
+  });
+
+  return {
+    observe: (element) => {
+      if (element) observer.observe(element);
+    },
+    disconnect: () => {
+      if (timer) clearTimeout(timer);
+      observer.disconnect();
+    }
+  };
+};
+
+// Returns the seller's phone number, or null when the backend has none (404).
+// Throws for any other failure.
+export const getSellerPhone = async (token, sellerId) => {
+  const cached = getCachedPhone(token, sellerId);
+  if (cached) {
+    recordContactClick(token, sellerId);
+    return cached;
+  }
+
+  // A direct lookup is recorded as a contact click by the backend
+  const response = await fetch(`${backendUrl}/api/seller-phone/${sellerId}`, {
+    headers: {
+      'Authorization': `Bearer ${token}`
+    }
+  });
+  if (response.status === 404) return null;
+  if (!response.ok) throw new Error(`Seller phone lookup failed with status ${response.status}`);
+
+  const data = await response.json();
+  if (data.phone_number) setCachedPhone(token, sellerId, data.phone_number);
+  return data.phone_number || null;
+};
@@ -7,12 +7,15 @@ BACKEND_URL = "https://agriplot-hub.preview.emergentagent.com"
 
 # Get the broker ID from the previous test
 broker_id = "7e156b0a-2285-487c-abda-8ab57f1992be"
+# Leads are only shown to the user whose phone number owns the broker profile
+broker_phone = "+919876543210"
 
 # Create a JWT token manually for the broker
 JWT_SECRET = "onlylands_secret_key_2025"
 payload = {
     "user_id": broker_id,
     "user_type": "broker",
+    "phone_number": broker_phone,
     "exp": datetime.utcnow() + timedelta(days=7)
 }
 token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
@@ -42,6 +45,24 @@ if leads_response.status_code == 200:
         print(f"Broadcast Sent: {leads[0].get('broadcast_sent')}")
     else:
         print("No leads found for the broker")
+    # Walk the remaining pages with the (created_at, lead_id) cursor
+    seen = {lead.get('lead_id') for lead in leads}
+    page = leads_response.json()
+    while page.get('next_before'):
+        page_response = requests.get(
+            f"{BACKEND_URL}/api/brokers/{broker_id}/leads",
+            headers=headers,
+            params={"before": page['next_before'], "before_id": page['next_before_id']}
+        )
+        if page_response.status_code != 200:
+            print(f"Failed to get next page with status code: {page_response.status_code}")
+            break
+        page = page_response.json()
+        page_ids = {lead.get('lead_id') for lead in page.get('leads', [])}
+        if seen & page_ids:
+            print(f"❌ Pages repeated {len(seen & page_ids)} leads")
+        seen |= page_ids
+    print(f"Paged through {len(seen)} leads in total")
 else:
     print(f"Failed to get leads with status code: {leads_response.status_code}")
     print(f"Response: {leads_response.text}")
\ No newline at end of file
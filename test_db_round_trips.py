@@ -0,0 +1,28 @@
+import requests
+
+# Backend URL
+BACKEND_URL = "https://agriplot-hub.preview.emergentagent.com"
+
+# Routes with a declared round-trip budget that can be called without logging in.
+# Run the backend with DB_BUDGET_MODE=strict to turn budget violations into 500s,
+# and with SERVER_TIMING_HEADER=true to see the Server-Timing breakdown.
+routes = {
+    "/api/listings": 1,
+    # One bounded query per seller
+    "/api/listings/preview/test-seller-123,test-seller-456": 2,
+}
+
+for path, budget in routes.items():
+    response = requests.get(f"{BACKEND_URL}{path}")
+    round_trips = response.headers.get("X-DB-Round-Trips")
+    print(f"{path}: {response.status_code}, X-DB-Round-Trips: {round_trips}, "
+          f"Server-Timing: {response.headers.get('Server-Timing')}")
+
+    if response.status_code == 500 and "budget exceeded" in response.text:
+        print(f"❌ Budget violation: {response.json().get('violations')}")
+    elif round_trips is None:
+        print("❌ X-DB-Round-Trips header missing")
+    elif int(round_trips) <= budget:
+        print(f"✅ Within budget ({round_trips}/{budget})")
+    else:
+        print(f"❌ Over budget ({round_trips}/{budget})")
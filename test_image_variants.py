@@ -0,0 +1,46 @@
+import requests
+
+# Backend URL
+BACKEND_URL = "https://agriplot-hub.preview.emergentagent.com"
+
+# Find an uploaded photo from the active listings
+print("Getting listings to find an uploaded photo...")
+listings_response = requests.get(f"{BACKEND_URL}/api/listings")
+photo_url = None
+if listings_response.status_code == 200:
+    for listing in listings_response.json().get('listings', []):
+        for photo in listing.get('photos', []):
+            if isinstance(photo, str) and photo.startswith('/api/uploads/'):
+                photo_url = photo
+                break
+        if photo_url:
+            break
+
+if not photo_url:
+    print("No locally stored photos found")
+else:
+    print(f"Using photo: {photo_url}")
+
+    original = requests.get(f"{BACKEND_URL}{photo_url}")
+    print(f"Original: {original.status_code}, {len(original.content)} bytes, "
+          f"Cache-Control: {original.headers.get('Cache-Control')}")
+
+    variant = requests.get(f"{BACKEND_URL}{photo_url}?w=320&fmt=webp")
+    print(f"Variant: {variant.status_code}, {len(variant.content)} bytes, "
+          f"Content-Type: {variant.headers.get('Content-Type')}, "
+          f"Cache-Control: {variant.headers.get('Cache-Control')}")
+
+    if variant.status_code == 200 and variant.headers.get('Content-Type') == 'image/webp':
+        print(f"✅ WebP variant served ({len(original.content) / max(len(variant.content), 1):.1f}x smaller)")
+    else:
+        print("❌ WebP variant not served")
+
+    # Second request should come straight from the variant cache
+    cached = requests.get(f"{BACKEND_URL}{photo_url}?w=320&fmt=webp")
+    if cached.status_code == 200 and cached.content == variant.content:
+        print("✅ Cached variant is identical")
+    else:
+        print("❌ Cached variant differs")
+
+    bad_format = requests.get(f"{BACKEND_URL}{photo_url}?w=320&fmt=tiff")
+    print(f"Unsupported format: {bad_format.status_code} (expected 400)")
@@ -0,0 +1,72 @@
+import requests
+import hmac
+import hashlib
+import json
+import os
+import uuid
+
+# Backend URL
+BACKEND_URL = "https://agriplot-hub.preview.emergentagent.com"
+
+# Must match RAZORPAY_WEBHOOK_SECRET in the backend .env
+WEBHOOK_SECRET = os.environ.get("RAZORPAY_WEBHOOK_SECRET", "onlylands_webhook_secret")
+
+# Order created by a previous /api/create-payment-order call
+razorpay_order_id = os.environ.get("RAZORPAY_ORDER_ID", "order_Qjo1uD8sq4Cir7")
+
+# Recorded payment.captured payload (trimmed to the fields the backend reads)
+recorded_event = {
+    "entity": "event",
+    "account_id": "acc_BFQ7uQEaa7j2z7",
+    "event": "payment.captured",
+    "contains": ["payment"],
+    "payload": {
+        "payment": {
+            "entity": {
+                "id": f"pay_test_{uuid.uuid4().hex[:10]}",
+                "entity": "payment",
+                "amount": 29900,
+                "currency": "INR",
+                "status": "captured",
+                "order_id": razorpay_order_id,
+                "method": "upi",
+                "captured": True,
+                "created_at": 1755254097
+            }
+        }
+    },
+    "created_at": 1755254100
+}
+
+body = json.dumps(recorded_event).encode()
+signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+event_id = f"evt_test_{uuid.uuid4().hex[:14]}"
+
+headers = {
+    'Content-Type': 'application/json',
+    'X-Razorpay-Signature': signature,
+    'X-Razorpay-Event-Id': event_id
+}
+
+print(f"Sending payment.captured webhook for order {razorpay_order_id} (event {event_id})...")
+response = requests.post(f"{BACKEND_URL}/api/webhooks/razorpay", data=body, headers=headers)
+print(f"Status: {response.status_code}, Response: {response.text}")
+if response.status_code == 200 and response.json().get("status") == "accepted":
+    print("✅ Webhook accepted")
+else:
+    print("❌ Webhook not accepted")
+
+print("\nRedelivering the same event...")
+response = requests.post(f"{BACKEND_URL}/api/webhooks/razorpay", data=body, headers=headers)
+if response.status_code == 200 and response.json().get("status") == "duplicate":
+    print("✅ Redelivery recognised as duplicate")
+else:
+    print(f"❌ Unexpected redelivery response: {response.status_code} {response.text}")
+
+print("\nSending webhook with a bad signature...")
+bad_headers = dict(headers, **{'X-Razorpay-Signature': '0' * 64, 'X-Razorpay-Event-Id': f"evt_test_{uuid.uuid4().hex[:14]}"})
+response = requests.post(f"{BACKEND_URL}/api/webhooks/razorpay", data=body, headers=bad_headers)
+if response.status_code == 400:
+    print("✅ Bad signature rejected")
+else:
+    print(f"❌ Bad signature not rejected: {response.status_code} {response.text}")